@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+End-to-end load benchmark for /chat and /stream.
+
+Drives the proxy at each concurrency level and reports throughput,
+time-to-first-token and p50/p95/p99 latency. With --spawn it starts
+bench/mock_upstream.py and a proxy wired to it on free ports, so the run
+needs no network and no real accounts:
+
+    python bench/loadtest.py --spawn --endpoint both --concurrency 1 8 32 --requests 200
+
+Against an already running proxy:
+
+    python bench/loadtest.py --url http://127.0.0.1:8080 --endpoint stream
+
+Proxy settings (SINGLE_FLIGHT, ACCOUNT_SELECTION, ...) are read from the
+environment as usual, so the spawned proxy can be tuned per run.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile; None for an empty list"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+@dataclass
+class Sample:
+    ok: bool
+    latency: float
+    ttft: Optional[float] = None
+    chars: int = 0
+    error: str = ''
+
+
+@dataclass
+class LevelResult:
+    endpoint: str
+    concurrency: int
+    wall: float
+    samples: List[Sample] = field(default_factory=list)
+
+    def summary(self) -> Dict:
+        ok = [s for s in self.samples if s.ok]
+        latencies = [s.latency for s in ok]
+        ttfts = [s.ttft for s in ok if s.ttft is not None]
+        errors: Dict[str, int] = {}
+        for s in self.samples:
+            if not s.ok:
+                errors[s.error] = errors.get(s.error, 0) + 1
+
+        def ms(value: Optional[float]) -> Optional[float]:
+            return round(value * 1000, 1) if value is not None else None
+
+        return {
+            "endpoint": self.endpoint,
+            "concurrency": self.concurrency,
+            "requests": len(self.samples),
+            "ok": len(ok),
+            "errors": errors,
+            "throughput_rps": round(len(ok) / self.wall, 2) if self.wall else 0.0,
+            "chars_per_s": round(sum(s.chars for s in ok) / self.wall, 1) if self.wall else 0.0,
+            "latency_ms": {p: ms(percentile(latencies, q)) for p, q in (("p50", 50), ("p95", 95), ("p99", 99))},
+            "ttft_ms": {p: ms(percentile(ttfts, q)) for p, q in (("p50", 50), ("p95", 95), ("p99", 99))},
+        }
+
+
+# ==============================================================================
+# Request drivers
+# ==============================================================================
+
+def make_body(args, index: int) -> Dict:
+    # A unique nonce keeps the response cache and single-flight out of the way
+    # unless --repeat asks for identical prompts
+    nonce = "same" if args.repeat else uuid.uuid4().hex[:12]
+    message = f"bench {nonce} #{index if not args.repeat else 0} " + "x" * args.message_chars
+    history = []
+    for turn in range(args.history):
+        history.append({"role": "user", "content": f"question {turn} " + "y" * args.message_chars})
+        history.append({"role": "assistant", "content": f"answer {turn} " + "z" * args.message_chars})
+    body = {"message": message, "history": history}
+    if args.model:
+        body["model"] = args.model
+    return body
+
+
+async def run_chat(http: ClientSession, url: str, body: Dict) -> Sample:
+    started = time.monotonic()
+    async with http.post(f"{url}/chat", json=body) as resp:
+        data = await resp.json(content_type=None)
+    latency = time.monotonic() - started
+    if resp.status != 200:
+        return Sample(False, latency, error=f"HTTP {resp.status}")
+    return Sample(True, latency, chars=len(data.get('response', '')))
+
+
+async def run_stream(http: ClientSession, url: str, body: Dict) -> Sample:
+    started = time.monotonic()
+    ttft = None
+    chars = 0
+    error = ''
+    event = ''
+    async with http.post(f"{url}/stream", json=body) as resp:
+        if resp.status != 200:
+            await resp.read()
+            return Sample(False, time.monotonic() - started, error=f"HTTP {resp.status}")
+        async for raw in resp.content:
+            line = raw.decode('utf-8').rstrip('\n')
+            if line.startswith('event: '):
+                event = line[7:]
+            elif line.startswith('data: ') and line != 'data: [DONE]':
+                data = json.loads(line[6:])
+                if event == 'error':
+                    error = f"event {data.get('status')}"
+                elif 'content' in data:
+                    if ttft is None:
+                        ttft = time.monotonic() - started
+                    chars += len(data['content'])
+            elif not line:
+                event = ''
+    latency = time.monotonic() - started
+    if error:
+        return Sample(False, latency, ttft, chars, error)
+    return Sample(True, latency, ttft, chars)
+
+
+async def run_level(args, url: str, endpoint: str, concurrency: int) -> LevelResult:
+    driver = run_stream if endpoint == 'stream' else run_chat
+    queue: asyncio.Queue = asyncio.Queue()
+    for index in range(args.requests):
+        queue.put_nowait(index)
+
+    result = LevelResult(endpoint, concurrency, 0.0)
+    connector = TCPConnector(limit=concurrency)
+    async with ClientSession(connector=connector, timeout=ClientTimeout(total=args.timeout)) as http:
+        async def worker():
+            while not queue.empty():
+                index = queue.get_nowait()
+                try:
+                    sample = await driver(http, url, make_body(args, index))
+                except Exception as e:
+                    sample = Sample(False, 0.0, error=type(e).__name__)
+                result.samples.append(sample)
+
+        started = time.monotonic()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        result.wall = time.monotonic() - started
+    return result
+
+
+# ==============================================================================
+# Spawned mock + proxy
+# ==============================================================================
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def wait_ready(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with ClientSession() as http:
+        while time.monotonic() < deadline:
+            try:
+                async with http.get(url) as resp:
+                    if resp.status == 200:
+                        return
+            except OSError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {timeout}s")
+
+
+def spawn(args) -> tuple:
+    """Start the mock upstream and a proxy pointed at it; returns (processes, proxy_url, mock_url)"""
+    mock_port, proxy_port = free_port(), free_port()
+    mock_cmd = [sys.executable, os.path.join(ROOT, 'bench', 'mock_upstream.py'), '--port', str(mock_port),
+                '--ttft', str(args.ttft), '--token-rate', str(args.token_rate), '--tokens', str(args.tokens),
+                '--rate-limit-prob', str(args.rate_limit_prob), '--error-prob', str(args.error_prob)]
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    env = dict(os.environ)
+    env.setdefault('WARMUP_ON_STARTUP', '1')
+    env.update(CLERK_BASE=f"{mock_url}/v1", OUTERFACE_BASE=f"{mock_url}/api")
+    proxy_cmd = [sys.executable, os.path.join(ROOT, 'venice_server.py'), '--host', '127.0.0.1', '--port', str(proxy_port)]
+
+    log = subprocess.DEVNULL if not args.verbose else None
+    processes = [
+        subprocess.Popen(mock_cmd, stdout=log, stderr=log),
+        subprocess.Popen(proxy_cmd, env=env, stdout=log, stderr=log),
+    ]
+    return processes, f"http://127.0.0.1:{proxy_port}", mock_url
+
+
+# ==============================================================================
+# Reporting
+# ==============================================================================
+
+def print_table(summaries: List[Dict]):
+    print(f"{'endpoint':<8} {'conc':>5} {'ok':>6} {'err':>5} {'req/s':>8} "
+          f"{'lat p50':>8} {'p95':>8} {'p99':>8} {'ttft p50':>9} {'p95':>8} {'p99':>8}")
+
+    def cell(value) -> str:
+        return '-' if value is None else f"{value:.0f}"
+
+    for s in summaries:
+        lat, ttft = s['latency_ms'], s['ttft_ms']
+        print(f"{s['endpoint']:<8} {s['concurrency']:>5} {s['ok']:>6} {s['requests'] - s['ok']:>5} "
+              f"{s['throughput_rps']:>8.1f} {cell(lat['p50']):>8} {cell(lat['p95']):>8} {cell(lat['p99']):>8} "
+              f"{cell(ttft['p50']):>9} {cell(ttft['p95']):>8} {cell(ttft['p99']):>8}")
+        if s['errors']:
+            print(f"{'':<8} errors: {s['errors']}")
+
+
+async def bench(args):
+    processes = []
+    url, mock_url = args.url.rstrip('/'), args.mock_url
+    try:
+        if args.spawn:
+            processes, url, mock_url = spawn(args)
+            await wait_ready(f"{mock_url}/mock/stats")
+            await wait_ready(f"{url}/health")
+            print(f"[Bench] Proxy {url} -> mock {mock_url}")
+
+        endpoints = ['chat', 'stream'] if args.endpoint == 'both' else [args.endpoint]
+        summaries = []
+        for endpoint in endpoints:
+            for concurrency in args.concurrency:
+                if args.warmup:
+                    await run_level(argparse.Namespace(**{**vars(args), 'requests': args.warmup}), url, endpoint, concurrency)
+                result = await run_level(args, url, endpoint, concurrency)
+                summaries.append(result.summary())
+                print(f"[Bench] {endpoint} x{concurrency}: {summaries[-1]['throughput_rps']} req/s")
+
+        report = {"url": url, "requests_per_level": args.requests, "levels": summaries}
+        if mock_url:
+            async with ClientSession() as http:
+                async with http.get(f"{mock_url}/mock/stats") as resp:
+                    report["upstream"] = (await resp.json())["stats"]
+
+        print()
+        print_table(summaries)
+        if "upstream" in report:
+            print(f"\nupstream: {report['upstream']}")
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"[Bench] Wrote {args.json}")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8080', help='proxy to benchmark')
+    parser.add_argument('--mock-url', default=None, help='mock upstream whose /mock/stats to include')
+    parser.add_argument('--spawn', action='store_true', help='start a mock upstream and proxy on free ports')
+    parser.add_argument('--endpoint', choices=['chat', 'stream', 'both'], default='both')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=100, help='requests per concurrency level')
+    parser.add_argument('--warmup', type=int, default=0, help='unmeasured requests before each level')
+    parser.add_argument('--message-chars', type=int, default=200)
+    parser.add_argument('--history', type=int, default=0, help='prior turns sent with each request')
+    parser.add_argument('--repeat', action='store_true', help='send identical prompts (exercises cache/single-flight)')
+    parser.add_argument('--model', default=None)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--json', default=None, help='write the report to this file')
+    parser.add_argument('--verbose', action='store_true', help='show spawned process output')
+    mock = parser.add_argument_group('spawned mock upstream')
+    mock.add_argument('--ttft', type=float, default=0.2)
+    mock.add_argument('--token-rate', type=float, default=50.0)
+    mock.add_argument('--tokens', type=int, default=60)
+    mock.add_argument('--rate-limit-prob', type=float, default=0.0)
+    mock.add_argument('--error-prob', type=float, default=0.0)
+    args = parser.parse_args()
+
+    asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    main()
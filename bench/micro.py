@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for the proxy's per-request Python work.
+
+Covers upstream payload construction, NDJSON parsing, SSE frame encoding,
+AccountPool.get_account under contention and get_status at 10/100/1,000
+accounts. JSON goes through the codec the proxy selects; run with
+JSON_BACKEND=stdlib to measure without orjson/msgspec. Each benchmark
+reports the median and best time per operation over several runs, with the
+garbage collector off as timeit does.
+
+    python bench/micro.py                                  # run and print
+    python bench/micro.py --save bench/micro_baseline.json # record a baseline
+    python bench/micro.py --compare bench/micro_baseline.json --threshold 0.25
+
+--compare exits with status 1 if any benchmark's best time is slower than
+the baseline's by more than the threshold; the best of several runs is far
+less noisy than the median on a shared machine. Baselines are machine-specific: record
+one on the machine that runs the comparison. A baseline also records the JSON
+codec; comparing against one taken with a different codec is skipped.
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import venice_server as vs  # noqa: E402
+
+# name -> (operations per run, runner(ops) -> elapsed seconds)
+BENCHMARKS: Dict[str, tuple] = {}
+
+
+def benchmark(name: str, ops: int):
+    def register(fn: Callable[[int], float]):
+        BENCHMARKS[name] = (ops, fn)
+        return fn
+    return register
+
+
+def make_accounts(count: int) -> List[Dict[str, str]]:
+    return [{"email": f"bench{i:05d}@example.com", "password": "x"} for i in range(count)]
+
+
+def ready_pool(count: int, strategy: str = 'least-in-flight') -> vs.AccountPool:
+    pool = vs.AccountPool(make_accounts(count), vs.SELECTION_STRATEGIES[strategy]())
+    for i, account in enumerate(pool.accounts):
+        account.jwt = "bench.jwt.token"
+        account.jwt_exp = time.time() + 3600
+        account.user_id = f"user_{i}"
+        account.latency_ewma = 0.05 + (i % 7) / 100
+    return pool
+
+
+HISTORY = [
+    {"role": "user" if i % 2 == 0 else "assistant", "content": f"turn {i} " + "lorem ipsum dolor " * 40}
+    for i in range(10)
+]
+
+
+def upstream_stream(frames: int, separators: tuple = (',', ':')) -> bytes:
+    """Content frames as upstream sends them (compact unless separators say otherwise)"""
+    words = ["Hello ", "wörld ", "\"quoted\" ", "line\n", "Привет ", "`code` "]
+    lines = [json.dumps({"kind": "content", "content": words[i % len(words)]},
+                        ensure_ascii=False, separators=separators)
+             for i in range(frames)]
+    return ("\n".join(lines) + "\n").encode('utf-8')
+
+
+def chunked(data: bytes, size: int) -> List[bytes]:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+# ==============================================================================
+# Payload construction
+# ==============================================================================
+
+@benchmark("payload_build", ops=20000)
+def bench_payload_build(ops: int) -> float:
+    account = ready_pool(1).accounts[0]
+    started = time.perf_counter()
+    for _ in range(ops):
+        prompt = vs.UpstreamClient.build_prompt("What is the meaning of life?", HISTORY)
+        vs.UpstreamClient.build_payload(account, vs.DEFAULT_MODEL, prompt)
+    return time.perf_counter() - started
+
+
+@benchmark("payload_build_serialize", ops=5000)
+def bench_payload_serialize(ops: int) -> float:
+    account = ready_pool(1).accounts[0]
+    started = time.perf_counter()
+    for _ in range(ops):
+        prompt = vs.UpstreamClient.build_prompt("What is the meaning of life?", HISTORY)
+        vs.CODEC.dumps(vs.UpstreamClient.build_payload(account, vs.DEFAULT_MODEL, prompt))
+    return time.perf_counter() - started
+
+
+# ==============================================================================
+# Stream parsing and encoding (one op = a 1,000-frame answer)
+# ==============================================================================
+
+STREAM = chunked(upstream_stream(1000), 512)
+SPACED_STREAM = chunked(upstream_stream(1000, separators=(', ', ': ')), 512)
+
+
+def parse_stream(raw: bool, ops: int, stream: List[bytes] = STREAM) -> float:
+    started = time.perf_counter()
+    for _ in range(ops):
+        parser = vs.NDJSONParser(raw=raw)
+        for chunk in stream:
+            parser.feed(chunk)
+        parser.flush()
+    return time.perf_counter() - started
+
+
+@benchmark("ndjson_parse_raw_1000", ops=50)
+def bench_ndjson_raw(ops: int) -> float:
+    return parse_stream(True, ops)
+
+
+@benchmark("ndjson_parse_decoded_1000", ops=50)
+def bench_ndjson_decoded(ops: int) -> float:
+    return parse_stream(False, ops)
+
+
+@benchmark("ndjson_parse_raw_1000_spaced", ops=50)
+def bench_ndjson_spaced(ops: int) -> float:
+    # Frames that miss the compact-prefix fast path (taken with the stdlib codec)
+    return parse_stream(True, ops, SPACED_STREAM)
+
+
+@benchmark("sse_encode_1000", ops=200)
+def bench_sse_encode(ops: int) -> float:
+    parser = vs.NDJSONParser(raw=True)
+    literals = [literal for chunk in STREAM for literal in parser.feed(chunk)]
+    started = time.perf_counter()
+    for _ in range(ops):
+        b"".join([vs.sse_content_frame(literal) for literal in literals])
+    return time.perf_counter() - started
+
+
+@benchmark("sse_event_meta", ops=100000)
+def bench_sse_event(ops: int) -> float:
+    started = time.perf_counter()
+    for _ in range(ops):
+        vs.sse_event('meta', {"remaining": 7})
+    return time.perf_counter() - started
+
+
+# ==============================================================================
+# Account pool
+# ==============================================================================
+
+def contended_get_account(strategy: str, accounts: int, tasks: int, ops: int) -> float:
+    """`tasks` concurrent callers each doing get_account/acquire/yield/release"""
+    async def run() -> float:
+        pool = ready_pool(accounts, strategy)
+        per_task = ops // tasks
+
+        async def caller():
+            for _ in range(per_task):
+                account = await pool.get_account()
+                pool.acquire(account)
+                await asyncio.sleep(0)
+                pool.release(account)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(caller() for _ in range(tasks)))
+        return time.perf_counter() - started
+
+    return asyncio.run(run())
+
+
+for _strategy in vs.SELECTION_STRATEGIES:
+    benchmark(f"get_account_{_strategy}_20x100", ops=20000)(
+        lambda ops, strategy=_strategy: contended_get_account(strategy, 20, 100, ops))
+
+
+def status_run(accounts: int, ops: int) -> float:
+    pool = ready_pool(accounts)
+    started = time.perf_counter()
+    for _ in range(ops):
+        vs.CODEC.dumps(pool.get_status())
+    return time.perf_counter() - started
+
+
+for _count, _ops in ((10, 5000), (100, 1000), (1000, 200)):
+    benchmark(f"get_status_{_count}", ops=_ops)(lambda ops, count=_count: status_run(count, ops))
+
+
+# ==============================================================================
+# Runner
+# ==============================================================================
+
+def run(names: List[str], repeat: int) -> Dict[str, Dict]:
+    results = {}
+    for name in names:
+        ops, fn = BENCHMARKS[name]
+        fn(max(1, ops // 10))  # warm caches and code paths
+        per_op = []
+        gc.disable()
+        try:
+            for _ in range(repeat):
+                per_op.append(fn(ops) / ops * 1e9)
+                gc.collect()
+        finally:
+            gc.enable()
+        results[name] = {
+            "median_ns": round(statistics.median(per_op), 1),
+            "best_ns": round(min(per_op), 1),
+            "ops": ops,
+            "repeat": repeat,
+        }
+        print(f"{name:<36} {results[name]['median_ns']:>14,.1f} ns/op  (best {results[name]['best_ns']:,.1f})")
+    return results
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], threshold: float) -> List[str]:
+    regressions = []
+    print(f"\n{'benchmark':<36} {'baseline':>12} {'now':>12} {'change':>8}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<36} {'-':>12} {result['best_ns']:>12,.0f} {'new':>8}")
+            continue
+        change = result['best_ns'] / base['best_ns'] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<36} {base['best_ns']:>12,.0f} {result['best_ns']:>12,.0f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--filter', default='', help='only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--save', help='write results as a baseline to this file')
+    parser.add_argument('--compare', help='baseline file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown, 0.2 = 20%%')
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS if args.filter in name]
+    results = run(names, args.repeat)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "codec": vs.CODEC.name,
+                "benchmarks": results,
+            }, f, indent=2)
+            f.write("\n")
+        print(f"[Micro] Wrote baseline {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        codec = baseline.get("codec", "stdlib")
+        if codec != vs.CODEC.name:
+            # Timings from different JSON backends aren't comparable
+            print(f"[Micro] Baseline was recorded with the {codec} codec, this run uses "
+                  f"{vs.CODEC.name}; skipping the comparison (set JSON_BACKEND={codec} to compare)")
+            return
+        regressions = compare(results, baseline["benchmarks"], args.threshold)
+        if regressions:
+            print(f"[Micro] {len(regressions)} regression(s) over {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print(f"[Micro] No regressions over {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Mock Venice/Clerk upstream for offline benchmarking.
+
+Imitates the Clerk sign-in flow AccountPool._login uses and the NDJSON
+/inference/chat stream UpstreamClient consumes, with configurable
+time-to-first-token, token rate, 429 and error injection.
+
+    python bench/mock_upstream.py --port 9100 --ttft 0.3 --token-rate 50
+
+Point the proxy at it with:
+
+    CLERK_BASE=http://127.0.0.1:9100/v1 OUTERFACE_BASE=http://127.0.0.1:9100/api \\
+        python venice_server.py
+
+GET /mock/stats returns request counters.
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import time
+from dataclasses import dataclass, asdict
+from typing import Dict
+
+from aiohttp import web
+
+
+# Answer text; includes quotes, escapes and non-ASCII to exercise the parser
+WORDS = [
+    "The ", "quick ", "brown ", "fox ", "jumps ", "over ", "the ", "lazy ", "dog. ",
+    "Привет, ", "мир! ", "naïve ", "café ", "\"quoted\" ", "back\\slash ", "tab\t", "line\n",
+    "`code` ", "**bold** ", "$x^2$ ",
+]
+
+
+@dataclass
+class MockConfig:
+    ttft: float = 0.2  # seconds from request to first content frame
+    ttft_jitter: float = 0.05  # stddev of ttft
+    token_rate: float = 50.0  # content frames per second, 0 = as fast as possible
+    tokens: int = 60  # content frames per answer
+    quota: int = 0  # prompts per user before 429, 0 = unlimited
+    rate_limit_prob: float = 0.0  # chance of a random 429
+    error_prob: float = 0.0  # chance of an HTTP 500 before streaming
+    drop_prob: float = 0.0  # chance of cutting the connection mid-stream
+    login_delay: float = 0.05  # latency of each Clerk call
+    jwt_ttl: int = 60
+
+
+@dataclass
+class MockStats:
+    logins: int = 0
+    token_requests: int = 0  # logins plus refreshes
+    chats: int = 0
+    completed: int = 0
+    rate_limited: int = 0
+    errors: int = 0
+    dropped: int = 0
+    aborted: int = 0  # proxy went away mid-stream
+    in_flight: int = 0
+    max_in_flight: int = 0
+
+
+def make_jwt(sub: str, ttl: int) -> str:
+    def b64(data: Dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+    return f"{b64({'alg': 'none'})}.{b64({'sub': sub, 'exp': int(time.time()) + ttl})}.mock"
+
+
+def jwt_claims(jwt: str) -> Dict:
+    payload = jwt.split('.')[1]
+    return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+
+
+class MockUpstream:
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.stats = MockStats()
+        self.used: Dict[str, int] = {}  # prompts per user id
+
+    # ---- Clerk ----
+
+    def _require_client(self, request: web.Request):
+        if '__client' not in request.cookies:
+            raise web.HTTPUnauthorized(text='{"errors":[{"code":"client_missing"}]}',
+                                       content_type='application/json')
+
+    async def client(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.config.login_delay)
+        response = web.json_response({"response": {"id": "client_mock"}})
+        response.set_cookie('__client', hashlib.sha1(str(random.random()).encode()).hexdigest())
+        return response
+
+    async def sign_in(self, request: web.Request) -> web.Response:
+        self._require_client(request)
+        await asyncio.sleep(self.config.login_delay)
+        data = await request.post()
+        identifier = base64.urlsafe_b64encode(data.get('identifier', '').encode()).decode().rstrip('=')
+        return web.json_response({"response": {"id": f"sia_{identifier}", "status": "needs_first_factor"}})
+
+    async def attempt_first_factor(self, request: web.Request) -> web.Response:
+        self._require_client(request)
+        await asyncio.sleep(self.config.login_delay)
+        sign_in_id = request.match_info['sign_in_id']
+        self.stats.logins += 1
+        return web.json_response({"response": {"status": "complete", "created_session_id": f"sess_{sign_in_id[4:]}"}})
+
+    async def tokens(self, request: web.Request) -> web.Response:
+        self._require_client(request)
+        await asyncio.sleep(self.config.login_delay)
+        session_id = request.match_info['session_id']
+        self.stats.token_requests += 1
+        user_id = "user_" + hashlib.sha1(session_id.encode()).hexdigest()[:16]
+        return web.json_response({"jwt": make_jwt(user_id, self.config.jwt_ttl)})
+
+    # ---- Inference ----
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        config = self.config
+        auth = request.headers.get('Authorization', '')
+        try:
+            claims = jwt_claims(auth.removeprefix('Bearer '))
+        except Exception:
+            return web.json_response({"error": "unauthorized"}, status=401)
+        if claims.get('exp', 0) < time.time():
+            return web.json_response({"error": "token expired"}, status=401)
+
+        body = await request.json()
+        user_id = body.get('userId', '')
+        self.stats.chats += 1
+
+        used = self.used.get(user_id, 0)
+        if (config.quota and used >= config.quota) or random.random() < config.rate_limit_prob:
+            self.stats.rate_limited += 1
+            return web.json_response({"error": "rate limited"}, status=429,
+                                     headers={"x-ratelimit-remaining": "0"})
+        if random.random() < config.error_prob:
+            self.stats.errors += 1
+            return web.json_response({"error": "injected failure"}, status=500)
+
+        self.used[user_id] = used + 1
+        remaining = max(config.quota - used - 1, 0) if config.quota else 1000
+
+        self.stats.in_flight += 1
+        self.stats.max_in_flight = max(self.stats.max_in_flight, self.stats.in_flight)
+        try:
+            response = web.StreamResponse(headers={
+                "Content-Type": "application/x-ndjson",
+                "x-ratelimit-remaining": str(remaining),
+            })
+            await response.prepare(request)
+            await asyncio.sleep(max(0.0, random.gauss(config.ttft, config.ttft_jitter)))
+
+            drop_at = random.randrange(config.tokens) if random.random() < config.drop_prob else -1
+            interval = 1 / config.token_rate if config.token_rate else 0
+            for i in range(config.tokens):
+                if i == drop_at:
+                    self.stats.dropped += 1
+                    request.transport.close()
+                    return response
+                frame = {"kind": "content", "content": WORDS[i % len(WORDS)]}
+                await response.write(json.dumps(frame, ensure_ascii=False, separators=(',', ':')).encode() + b"\n")
+                if interval:
+                    await asyncio.sleep(interval)
+            await response.write_eof()
+            self.stats.completed += 1
+            return response
+        except (asyncio.CancelledError, ConnectionError):
+            self.stats.aborted += 1
+            raise
+        finally:
+            self.stats.in_flight -= 1
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"config": asdict(self.config), "stats": asdict(self.stats)})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/v1/client', self.client)
+        app.router.add_post('/v1/client/sign_ins', self.sign_in)
+        app.router.add_post('/v1/client/sign_ins/{sign_in_id}/attempt_first_factor', self.attempt_first_factor)
+        app.router.add_post('/v1/client/sessions/{session_id}/tokens', self.tokens)
+        app.router.add_post('/api/inference/chat', self.chat)
+        app.router.add_get('/mock/stats', self.get_stats)
+        return app
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    defaults = MockConfig()
+    for name, value in asdict(defaults).items():
+        parser.add_argument('--' + name.replace('_', '-'), type=type(value), default=value)
+    args = parser.parse_args()
+
+    config = MockConfig(**{name: getattr(args, name) for name in asdict(defaults)})
+    print(f"[Mock] Listening on {args.host}:{args.port} {asdict(config)}", flush=True)
+    web.run_app(MockUpstream(config).app(), host=args.host, port=args.port, print=None,
+                handler_cancellation=True)
+
+
+if __name__ == "__main__":
+    main()
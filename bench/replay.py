@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Replay captured traffic against a proxy.
+
+Reads a capture written by the proxy with TRAFFIC_CAPTURE=<file> and
+re-issues each request with the recorded endpoint, model, message and
+history sizes, inter-arrival times and client disconnects. Message text is
+not captured, so bodies are synthesized at the recorded sizes. History is
+always sent inline: for requests that relied on the server-side store, its
+size is estimated from the capture's average chars per turn.
+
+    python bench/replay.py capture.jsonl --url http://127.0.0.1:8080
+    python bench/replay.py capture.jsonl --spawn --speed 4 --multiply 3
+
+--speed compresses the gaps between arrivals, and --multiply issues every
+request N times. Together they scale recorded traffic up. Disconnect
+timing is replayed as recorded, unless --no-disconnects is given.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from loadtest import LevelResult, Sample, print_table, run_chat, run_stream, spawn, wait_ready  # noqa: E402
+
+DEFAULT_TURN_CHARS = 400
+
+
+def load_capture(path: str) -> List[Dict]:
+    """Records in file order; a `capture_started` line becomes a segment marker"""
+    records = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            records.append({"segment": True} if "capture_started" in record else record)
+    return records
+
+
+def turn_chars(records: List[Dict]) -> int:
+    """Average chars per history turn over records that sent history inline"""
+    turns = chars = 0
+    for r in records:
+        if r.get("history_inline") and r.get("history_turns"):
+            turns += r["history_turns"]
+            chars += r["history_chars"] or 0
+    return chars // turns if turns else DEFAULT_TURN_CHARS
+
+
+def make_body(record: Dict, conversations: Dict[str, str], per_turn: int) -> Dict:
+    nonce = uuid.uuid4().hex[:12]
+    message = f"replay {nonce} " + "x" * max(0, record["message_chars"] - 20)
+
+    turns = record.get("history_turns") or 0
+    chars = record["history_chars"] if record.get("history_chars") is not None else turns * per_turn
+    size = chars // turns if turns else 0
+    history = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": "h" * size}
+        for i in range(turns)
+    ]
+
+    body = {"message": message, "history": history, "model": record.get("model")}
+    conversation = record.get("conversation")
+    if conversation:
+        body["conversation_id"] = conversations.setdefault(conversation, f"replay-{uuid.uuid4().hex[:16]}")
+    return body
+
+
+class Replayer:
+    def __init__(self, args, url: str):
+        self.args = args
+        self.url = url
+        self.results: Dict[str, LevelResult] = {}
+        self.conversations: Dict[str, str] = {}
+        self.in_flight = 0
+        self.peak = 0
+        self.disconnects = 0
+
+    async def issue(self, http: ClientSession, record: Dict, per_turn: int):
+        endpoint = record["endpoint"].lstrip('/')
+        driver = run_stream if endpoint == 'stream' else run_chat
+        body = make_body(record, self.conversations, per_turn)
+        disconnect = None if self.args.no_disconnects else record.get("disconnected_after")
+
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        started = time.monotonic()
+        try:
+            sample = await asyncio.wait_for(driver(http, self.url, body), timeout=disconnect)
+        except asyncio.TimeoutError:
+            self.disconnects += 1
+            sample = Sample(False, time.monotonic() - started, error="disconnect (replayed)")
+        except Exception as e:
+            sample = Sample(False, time.monotonic() - started, error=type(e).__name__)
+        finally:
+            self.in_flight -= 1
+
+        result = self.results.setdefault(endpoint, LevelResult(endpoint, 0, 0.0))
+        result.samples.append(sample)
+
+    async def run(self, records: List[Dict]) -> float:
+        per_turn = turn_chars(records)
+        connector = TCPConnector(limit=0)
+        timeout = ClientTimeout(total=self.args.timeout)
+        async with ClientSession(connector=connector, timeout=timeout) as http:
+            tasks = []
+            started = time.monotonic()
+            offset = 0.0
+            previous: Optional[float] = None
+
+            for record in records:
+                if record.get("segment"):
+                    previous = None  # gaps across proxy restarts are not replayed
+                    continue
+                if previous is not None:
+                    offset += max(0.0, record["t"] - previous) / self.args.speed
+                previous = record["t"]
+
+                delay = started + offset - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                for _ in range(self.args.multiply):
+                    tasks.append(asyncio.create_task(self.issue(http, record, per_turn)))
+
+            await asyncio.gather(*tasks)
+            return time.monotonic() - started
+
+
+async def replay(args):
+    records = load_capture(args.capture)
+    if args.limit:
+        records = records[:args.limit]
+    requests = sum(1 for r in records if not r.get("segment"))
+    print(f"[Replay] {requests} recorded requests x{args.multiply} at {args.speed}x speed")
+
+    processes = []
+    url = args.url.rstrip('/')
+    try:
+        if args.spawn:
+            processes, url, mock_url = spawn(args)
+            await wait_ready(f"{mock_url}/mock/stats")
+            await wait_ready(f"{url}/health")
+            print(f"[Replay] Proxy {url} -> mock {mock_url}")
+
+        replayer = Replayer(args, url)
+        wall = await replayer.run(records)
+
+        summaries = []
+        for result in replayer.results.values():
+            result.wall = wall
+            result.concurrency = replayer.peak
+            summaries.append(result.summary())
+
+        print()
+        print_table(summaries)
+        print(f"\npeak concurrency {replayer.peak}, replayed disconnects {replayer.disconnects}, wall {wall:.1f}s")
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({"capture": args.capture, "speed": args.speed, "multiply": args.multiply,
+                           "peak_concurrency": replayer.peak, "levels": summaries}, f, indent=2)
+            print(f"[Replay] Wrote {args.json}")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('capture', help='JSONL file written with TRAFFIC_CAPTURE')
+    parser.add_argument('--url', default='http://127.0.0.1:8080', help='proxy to replay against')
+    parser.add_argument('--spawn', action='store_true', help='start a mock upstream and proxy on free ports')
+    parser.add_argument('--speed', type=float, default=1.0, help='arrival-time compression, 2 = twice as fast')
+    parser.add_argument('--multiply', type=int, default=1, help='issue every recorded request this many times')
+    parser.add_argument('--limit', type=int, default=0, help='replay only the first N lines')
+    parser.add_argument('--no-disconnects', action='store_true', help='let every request run to completion')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--json', default=None, help='write the report to this file')
+    parser.add_argument('--verbose', action='store_true', help='show spawned process output')
+    mock = parser.add_argument_group('spawned mock upstream')
+    mock.add_argument('--ttft', type=float, default=0.2)
+    mock.add_argument('--token-rate', type=float, default=50.0)
+    mock.add_argument('--tokens', type=int, default=60)
+    mock.add_argument('--rate-limit-prob', type=float, default=0.0)
+    mock.add_argument('--error-prob', type=float, default=0.0)
+    args = parser.parse_args()
+
+    asyncio.run(replay(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,10 +11,46 @@ import json
 import uuid
 import time
 import base64
+import bisect
+import gzip
+import hashlib
+import mimetypes
 import os
-from aiohttp import web, ClientSession, CookieJar
-from typing import Optional, List, Dict
+import posixpath
+import random
+import re
+import signal
+import socket
+import sqlite3
+import tempfile
+import threading
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector, CookieJar, DummyCookieJar
+from http.cookies import SimpleCookie
+from yarl import URL
+from typing import Optional, List, Dict, AsyncIterator
 from dataclasses import dataclass, field
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 
 # ==============================================================================
@@ -125,20 +161,385 @@ async def save_accounts_to_gist():
 
 DEFAULT_MODEL = "zai-org-glm-4.7-flash"  # GLM 4.7 Flash - follows instructions better
 
+# Models that get their own metric label; other client-supplied names are
+# reported as "other". KNOWN_MODELS (comma-separated) adds to the set.
+KNOWN_MODELS = {DEFAULT_MODEL} | {
+    name.strip() for name in os.environ.get('KNOWN_MODELS', '').split(',') if name.strip()
+}
+
+# Estimated-token budget for the history forwarded upstream, per model.
+# Newest turns are kept verbatim; older ones are trimmed, then dropped.
+DEFAULT_HISTORY_BUDGET = int(os.environ.get('HISTORY_TOKEN_BUDGET', 24000))
+HISTORY_BUDGETS = {
+    "zai-org-glm-4.7-flash": DEFAULT_HISTORY_BUDGET,
+}
+
 SYSTEM_PROMPT = """You are Nocturne, an AI assistant by Alphy.
 * If asked your name or identity, say you are Nocturne by Alphy. Do NOT introduce yourself unless asked.
 * Match the user's language (e.g., reply in Russian if they write in Russian).
 * Be accurate and concise. If uncertain, say so.
 * Never claim to be another AI system."""
 
-CLERK_BASE = "https://clerk.venice.ai/v1"
-OUTERFACE_BASE = "https://outerface.venice.ai/api"
+# Startup warm-up: log accounts in concurrently before taking traffic.
+# /health reports not-ready until MIN_READY_ACCOUNTS hold a JWT.
+WARMUP_ON_STARTUP = os.environ.get('WARMUP_ON_STARTUP', '0') == '1'
+WARMUP_CONCURRENCY = int(os.environ.get('WARMUP_CONCURRENCY', 5))
+MIN_READY_ACCOUNTS = int(os.environ.get('MIN_READY_ACCOUNTS', 1 if WARMUP_ON_STARTUP else 0))
+
+# Renew session tokens this many seconds before their `exp` claim
+JWT_REFRESH_MARGIN = float(os.environ.get('JWT_REFRESH_MARGIN', 15))
+JWT_REFRESH_MAX_SLEEP = 30.0
+
+# One keep-alive pool for all upstream traffic, shared by every account
+UPSTREAM_LIMIT = int(os.environ.get('UPSTREAM_LIMIT', 100))
+UPSTREAM_LIMIT_PER_HOST = int(os.environ.get('UPSTREAM_LIMIT_PER_HOST', 0))
+UPSTREAM_DNS_TTL = int(os.environ.get('UPSTREAM_DNS_TTL', 300))
+UPSTREAM_KEEPALIVE = float(os.environ.get('UPSTREAM_KEEPALIVE', 30))
+
+# Per-phase upstream timeouts in seconds; 0 disables one
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 10)) or None
+UPSTREAM_FIRST_BYTE_TIMEOUT = float(os.environ.get('UPSTREAM_FIRST_BYTE_TIMEOUT', 60)) or None
+UPSTREAM_IDLE_TIMEOUT = float(os.environ.get('UPSTREAM_IDLE_TIMEOUT', 60)) or None
+LOGIN_TIMEOUT = float(os.environ.get('LOGIN_TIMEOUT', 20)) or None
+
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36"
+
+# SSE relay: coalesce streamed tokens into one write per interval or size
+SSE_FLUSH_INTERVAL = float(os.environ.get('SSE_FLUSH_INTERVAL', 0.02))
+SSE_FLUSH_BYTES = int(os.environ.get('SSE_FLUSH_BYTES', 4096))
+# Comment frames sent while waiting for the first token, so proxies and
+# clients see a live stream during account selection, login and connect
+SSE_HEARTBEAT_INTERVAL = float(os.environ.get('SSE_HEARTBEAT_INTERVAL', 2))
+
+# Self-hosted UI assets. `python venice_server.py --fetch-assets` downloads
+# these into STATIC_DIR at build time; anything missing falls back to the CDN.
+STATIC_DIR = os.environ.get('STATIC_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+
+VENDOR_ASSETS = {
+    "vendor/marked.min.js": "https://cdnjs.cloudflare.com/ajax/libs/marked/11.1.1/marked.min.js",
+    "vendor/highlight.min.js": "https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/highlight.min.js",
+    "vendor/atom-one-dark.min.css": "https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/styles/atom-one-dark.min.css",
+    "vendor/katex/katex.min.js": "https://cdnjs.cloudflare.com/ajax/libs/KaTeX/0.16.9/katex.min.js",
+    "vendor/katex/katex.min.css": "https://cdnjs.cloudflare.com/ajax/libs/KaTeX/0.16.9/katex.min.css",
+    "vendor/montserrat/montserrat.css": "https://fonts.googleapis.com/css2?family=Montserrat:wght@400;500;600;700&display=swap",
+}
+
+# Server-side conversation history. 0 disables the store; set
+# CONVERSATION_DB to a file path to also persist histories in SQLite.
+CONVERSATION_STORE_SIZE = int(os.environ.get('CONVERSATION_STORE_SIZE', 500))
+CONVERSATION_DB = os.environ.get('CONVERSATION_DB', '')
+
+# Opt-in cache for identical prompts: RESPONSE_CACHE_SIZE entries, TTL seconds
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 0))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 600))
+
+# Identical concurrent prompts share one upstream generation
+SINGLE_FLIGHT = os.environ.get('SINGLE_FLIGHT', '1') == '1'
+
+# Admission control: at most ACCOUNT_MAX_IN_FLIGHT upstream requests per
+# account; ADMISSION_MAX_ACTIVE caps the total (0 = derived from the pool).
+# Excess requests wait in a bounded queue, then get a 503 with Retry-After.
+ACCOUNT_MAX_IN_FLIGHT = int(os.environ.get('ACCOUNT_MAX_IN_FLIGHT', 4))
+ADMISSION_MAX_ACTIVE = int(os.environ.get('ADMISSION_MAX_ACTIVE', 0))
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', 100))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 10))
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 2))
+
+# Account selection policy: least-in-flight, p2c, latency or sequential
+ACCOUNT_SELECTION = os.environ.get('ACCOUNT_SELECTION', 'least-in-flight')
+LATENCY_EWMA_ALPHA = float(os.environ.get('LATENCY_EWMA_ALPHA', 0.3))
+
+# Hedged /chat: race a second account when the first has produced nothing
+# after the HEDGE_PERCENTILE of recent time-to-first-token. HEDGE_BUDGET caps
+# hedges as a fraction of requests.
+HEDGE_REQUESTS = os.environ.get('HEDGE_REQUESTS', '0') == '1'
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 95))
+HEDGE_BUDGET = float(os.environ.get('HEDGE_BUDGET', 0.05))
+HEDGE_MIN_SAMPLES = int(os.environ.get('HEDGE_MIN_SAMPLES', 20))
+
+# Worker processes sharing the listening socket. Account state (sessions,
+# in-flight slots, exhaustion) is shared through SHARED_STATE: "local" keeps
+# it in-process, "sqlite" coordinates workers through SHARED_STATE_DB, which
+# holds account passwords: by default it lives in a per-user 0700 directory.
+WORKERS = int(os.environ.get('WORKERS', 1))
+SHARED_STATE = os.environ.get('SHARED_STATE', 'sqlite' if WORKERS > 1 else 'local')
+SHARED_STATE_DB = os.environ.get('SHARED_STATE_DB', os.path.join(tempfile.gettempdir(), f'nocturne-{os.getuid()}', 'state.db'))
+SHARED_STATE_SYNC = float(os.environ.get('SHARED_STATE_SYNC', 0.05))
+# Each worker publishes its metrics and /status counters this often, so a
+# scrape of the shared port reports every worker (series get a `worker` label)
+WORKER_REPORT_INTERVAL = float(os.environ.get('WORKER_REPORT_INTERVAL', 1.0))
+# Longest the event loop may block waiting for another worker's write lock
+SHARED_STATE_BUSY_TIMEOUT = float(os.environ.get('SHARED_STATE_BUSY_TIMEOUT', 0.05))
+
+# Append anonymized /chat and /stream request shapes to this JSONL file
+# for bench/replay.py; empty = off
+TRAFFIC_CAPTURE = os.environ.get('TRAFFIC_CAPTURE', '')
+
+# JSON codec and event loop: "auto" takes the fastest installed backend
+# (orjson, then msgspec; uvloop), or name one to pin it
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+EVENT_LOOP = os.environ.get('EVENT_LOOP', 'auto')
+
+# Overridable to point the proxy at bench/mock_upstream.py
+CLERK_BASE = os.environ.get('CLERK_BASE', "https://clerk.venice.ai/v1")
+OUTERFACE_BASE = os.environ.get('OUTERFACE_BASE', "https://outerface.venice.ai/api")
+
+
+# ==============================================================================
+# JSON Codec and Event Loop
+# ==============================================================================
+
+class JSONCodec:
+    """Stdlib JSON with a bytes API: compact, UTF-8, non-ASCII left unescaped.
+
+    Subclasses swap in a faster library; all of them raise ValueError on
+    malformed input so callers don't depend on the backend.
+    """
+    name = "stdlib"
+    native = False  # C-accelerated decode: cheaper than NDJSONParser's prefix fast path
+
+    def dumps(self, obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+    name = "orjson"
+    native = True
+
+    def dumps(self, obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, data):
+        return orjson.loads(data)  # JSONDecodeError is a ValueError
+
+
+class MsgspecCodec(JSONCodec):
+    name = "msgspec"
+    native = True
+
+    def __init__(self):
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder()
+
+    def dumps(self, obj) -> bytes:
+        return self._encoder.encode(obj)
+
+    def loads(self, data):
+        try:
+            return self._decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from None
+
+
+JSON_CODECS = {
+    "orjson": (OrjsonCodec, orjson),
+    "msgspec": (MsgspecCodec, msgspec),
+    "stdlib": (JSONCodec, json),
+}
+
+
+def select_codec(backend: str = JSON_BACKEND) -> JSONCodec:
+    """Codec for `backend`, or the first installed one for "auto"; falls back to stdlib"""
+    names = list(JSON_CODECS) if backend == 'auto' else [backend]
+    for name in names:
+        cls, module = JSON_CODECS.get(name, (None, None))
+        if module is not None:
+            return cls()
+    if backend != 'auto':
+        print(f"[Config] JSON backend {backend!r} not available, using stdlib")
+    return JSONCodec()
+
+
+CODEC = select_codec()
+
+
+def install_event_loop(choice: str = EVENT_LOOP) -> str:
+    """Set the loop policy used by run_app; returns the loop name"""
+    if choice in ('auto', 'uvloop') and uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        return "uvloop"
+    if choice == 'uvloop':
+        print("[Config] uvloop not installed, using asyncio")
+    return "asyncio"
+
+
+def running_loop_name() -> str:
+    return "uvloop" if type(asyncio.get_running_loop()).__module__.startswith('uvloop') else "asyncio"
+
+
+async def read_json(request: web.Request):
+    """Parse a request body with CODEC; raises ValueError if it isn't JSON"""
+    return CODEC.loads(await request.read())
+
+
+def json_response(data, status: int = 200, headers: Optional[Dict] = None) -> web.Response:
+    return web.Response(body=CODEC.dumps(data), status=status, headers=headers,
+                        content_type='application/json')
+
+
+# ==============================================================================
+# Metrics
+# ==============================================================================
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _label_str(labels: tuple) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self) -> list:
+        return list(self._values.items())
+
+    def lines(self, labels: tuple, value: float) -> List[str]:
+        return [f"{self.name}{_label_str(labels)} {value}"]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series: Dict[tuple, list] = {}  # labels -> [bucket counts, sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def snapshot(self) -> list:
+        return list(self._series.items())
+
+    def lines(self, labels: tuple, series: list) -> List[str]:
+        counts, total, count = series
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            lines.append(f"{self.name}_bucket{_label_str(labels + (('le', bound),))} {cumulative}")
+        lines.append(f"{self.name}_bucket{_label_str(labels + (('le', '+Inf'),))} {count}")
+        lines.append(f"{self.name}_sum{_label_str(labels)} {total}")
+        lines.append(f"{self.name}_count{_label_str(labels)} {count}")
+        return lines
+
+
+class Gauge:
+    """Value read from a callback at scrape time"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def snapshot(self) -> list:
+        return [((), self.read())]
+
+    def lines(self, labels: tuple, value: float) -> List[str]:
+        return [f"{self.name}{_label_str(labels)} {value}"]
+
+
+class MetricsRegistry:
+    """Minimal Prometheus text-format registry"""
+
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def _add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._add(Counter(name, help))
+
+    def histogram(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, buckets))
+
+    def gauge(self, name: str, help: str, read) -> Gauge:
+        return self._add(Gauge(name, help, read))
+
+    def snapshot(self) -> Dict[str, list]:
+        """Current series as JSON-serializable [labels, value] pairs per metric"""
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def render(self, workers: Optional[Dict[str, Dict[str, list]]] = None) -> str:
+        """Prometheus text for this process, or for every worker's snapshot
+        with a `worker` label added to each series"""
+        if workers is None:
+            sources = [((), self.snapshot())]
+        else:
+            sources = [((('worker', w),), workers[w]) for w in sorted(workers, key=int)]
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for extra, snapshot in sources:
+                for labels, value in snapshot.get(name, ()):
+                    # JSON turns label tuples into lists
+                    lines.extend(metric.lines(extra + tuple(tuple(pair) for pair in labels), value))
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+TTFT = METRICS.histogram("nocturne_ttft_seconds", "Request start to first content delta")
+STREAM_DURATION = METRICS.histogram("nocturne_stream_duration_seconds", "Request start to end of answer")
+UPSTREAM_CONNECT = METRICS.histogram("nocturne_upstream_connect_seconds", "Upstream request to response headers")
+LOGIN_DURATION = METRICS.histogram("nocturne_login_duration_seconds", "Full Clerk login")
+QUEUE_WAIT = METRICS.histogram("nocturne_queue_wait_seconds", "Time spent waiting for admission")
+RATE_LIMITED = METRICS.counter("nocturne_upstream_429_total", "Upstream 429 responses")
+RETRIES = METRICS.counter("nocturne_upstream_retries_total", "Upstream attempts after the first")
+ROTATIONS = METRICS.counter("nocturne_account_rotations_total", "Accounts marked exhausted")
+PARSE_ERRORS = METRICS.counter("nocturne_parse_errors_total", "Malformed upstream NDJSON frames")
+UPSTREAM_ERRORS = METRICS.counter("nocturne_upstream_errors_total", "Failed upstream attempts")
+HEDGES = METRICS.counter("nocturne_hedged_requests_total", "Hedge attempts started, by winner")
+
+
+def metric_model(model: Optional[str]) -> str:
+    """Model label value; unknown client-supplied names are folded together"""
+    model = model or DEFAULT_MODEL
+    return model if model in KNOWN_MODELS else "other"
 
 
 # ==============================================================================
 # Account Management
 # ==============================================================================
 
+def decode_jwt_claims(jwt: str) -> Dict:
+    """Decode a JWT payload without verifying it"""
+    payload = jwt.split('.')[1]
+    payload += '=' * (4 - len(payload) % 4)
+    return json.loads(base64.urlsafe_b64decode(payload))
+
+
 @dataclass
 class Account:
     email: str
@@ -146,37 +547,494 @@ class Account:
     jwt: Optional[str] = None
     user_id: Optional[str] = None
     session_id: Optional[str] = None
+    jwt_exp: float = 0.0
+    in_flight: int = 0
+    latency_ewma: float = 0.0  # seconds to upstream response headers
     remaining: int = 10
     exhausted: bool = False
-    http: Optional[ClientSession] = field(default=None, repr=False)
+    cookies: Optional[CookieJar] = field(default=None, repr=False)
+    login_task: Optional[asyncio.Task] = field(default=None, repr=False)
+    refresh_task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+    def token_valid(self) -> bool:
+        return bool(self.jwt) and (not self.jwt_exp or self.jwt_exp > time.time())
+
+    def cookie_jar(self) -> CookieJar:
+        """Domain-scoped cookies; created on first use since a jar needs a running loop"""
+        if self.cookies is None:
+            self.cookies = CookieJar(unsafe=True)
+        return self.cookies
+
+
+class SelectionStrategy:
+    """Picks one account from the ready candidates (given in rotation order)"""
+    name = "base"
+
+    def choose(self, candidates: List[Account]) -> Account:
+        raise NotImplementedError
+
+
+class SequentialStrategy(SelectionStrategy):
+    """Stay on one account until it is exhausted or full"""
+    name = "sequential"
+
+    def choose(self, candidates: List[Account]) -> Account:
+        return candidates[0]
+
+
+class LeastInFlightStrategy(SelectionStrategy):
+    """Fewest requests in flight; ties go to the lower latency, then rotation order"""
+    name = "least-in-flight"
+
+    def choose(self, candidates: List[Account]) -> Account:
+        return min(candidates, key=lambda a: (a.in_flight, a.latency_ewma))
+
+
+class PowerOfTwoStrategy(SelectionStrategy):
+    """Power of two choices: the less loaded of two random candidates"""
+    name = "p2c"
+
+    def choose(self, candidates: List[Account]) -> Account:
+        if len(candidates) < 2:
+            return candidates[0]
+        a, b = random.sample(candidates, 2)
+        return min((a, b), key=lambda x: (x.in_flight, x.latency_ewma))
+
+
+class LatencyWeightedStrategy(SelectionStrategy):
+    """Random pick weighted by 1 / (EWMA latency * (1 + in flight))"""
+    name = "latency"
+
+    def choose(self, candidates: List[Account]) -> Account:
+        known = [a.latency_ewma for a in candidates if a.latency_ewma]
+        default = sum(known) / len(known) if known else 1.0
+        weights = [1.0 / ((a.latency_ewma or default) * (1 + a.in_flight)) for a in candidates]
+        return random.choices(candidates, weights=weights)[0]
+
+
+SELECTION_STRATEGIES = {
+    cls.name: cls for cls in
+    (SequentialStrategy, LeastInFlightStrategy, PowerOfTwoStrategy, LatencyWeightedStrategy)
+}
+
+
+class SharedState:
+    """Account state shared between worker processes.
+
+    This default keeps everything in the current process. Backends for
+    several workers make sure an account is logged in by one worker only,
+    that its in-flight slots are counted across all of them and that
+    exhaustion is seen everywhere.
+    """
+    name = "local"
+    remote = False  # state can change without this process noticing
+    poll_interval: Optional[float] = None
+
+    def register(self, accounts: List[Account]):
+        pass
+
+    def sync(self, pool: 'AccountPool', force: bool = False):
+        """Pull other workers' changes into the pool's Account objects"""
+
+    def acquire(self, account: Account, limit: int) -> bool:
+        account.in_flight += 1
+        return True
+
+    def release(self, account: Account):
+        account.in_flight -= 1
+
+    def lease(self, account: Account, ttl: float) -> bool:
+        return True
+
+    def release_lease(self, account: Account):
+        pass
+
+    def publish_session(self, account: Account):
+        pass
+
+    def mark_exhausted(self, account: Account):
+        pass
+
+    def add_account(self, account: Account):
+        pass
+
+    def publish_report(self, worker: int, report: Dict):
+        """Store this worker's metrics and stats for the others to serve"""
+        pass
+
+    def reports(self) -> Dict[str, Dict]:
+        """Latest report of every worker, keyed by worker index"""
+        return {}
+
+    def close(self):
+        pass
+
+
+class SQLiteState(SharedState):
+    """Shared state in a SQLite file used by every worker on the host.
+
+    In-flight slots are rows per (account, pid), booked in an IMMEDIATE
+    transaction so two workers can't both take an account's last slot;
+    rows of dead workers are dropped on startup. Sessions carry a version
+    that other workers adopt on sync, and logins take a lease with a TTL.
+
+    Statements are tiny and run inline on the event loop with a short busy
+    timeout. A write that still finds the file locked is queued and retried
+    on the next sync; a locked slot booking or lease just reports failure.
+
+    The file and its -wal/-shm sidecars are created owner-only, and a file
+    or directory planted by another user is refused.
+    """
+    name = "sqlite"
+    remote = True
+
+    def __init__(self, path: str = SHARED_STATE_DB, sync_interval: float = SHARED_STATE_SYNC,
+                 busy_timeout: float = SHARED_STATE_BUSY_TIMEOUT):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.poll_interval = sync_interval * 2
+        self.pid = os.getpid()
+        self._synced = 0.0
+        self._versions: Dict[str, int] = {}
+        self._pending: deque = deque()  # (sql, params) writes that found the file locked
+        self._check_private(path)
+        # Sidecars appear on the first access in WAL mode, so they inherit the umask
+        umask = os.umask(0o077)
+        try:
+            self._open(path)
+        finally:
+            os.umask(umask)
+        self._drop_dead_workers()
+        self._db.execute(f"PRAGMA busy_timeout = {int(busy_timeout * 1000)}")
+
+    @staticmethod
+    def _check_private(path: str):
+        """Create the directory 0700 and refuse files another user owns"""
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        uid = os.getuid()
+        st = os.stat(directory)
+        if st.st_uid not in (uid, 0):
+            raise PermissionError(f"{directory} is owned by uid {st.st_uid}, refusing to keep state there")
+        for name in (path, path + '-wal', path + '-shm'):
+            try:
+                st = os.lstat(name)
+            except FileNotFoundError:
+                continue
+            if st.st_uid != uid or not os.path.isfile(name) or os.path.islink(name):
+                raise PermissionError(f"{name} is not a regular file owned by uid {uid}, refusing to open it")
+
+    def _open(self, path: str):
+        # Generous timeout while workers create the schema together, short afterwards
+        self._db = sqlite3.connect(path, timeout=5.0, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS accounts (
+                email TEXT PRIMARY KEY,
+                password TEXT NOT NULL,
+                jwt TEXT,
+                jwt_exp REAL NOT NULL DEFAULT 0,
+                user_id TEXT,
+                session_id TEXT,
+                cookies TEXT NOT NULL DEFAULT '[]',
+                exhausted INTEGER NOT NULL DEFAULT 0,
+                version INTEGER NOT NULL DEFAULT 0,
+                lease_owner INTEGER NOT NULL DEFAULT 0,
+                lease_until REAL NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS in_flight (
+                email TEXT NOT NULL,
+                pid INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (email, pid)
+            );
+            CREATE TABLE IF NOT EXISTS reports (
+                worker INTEGER PRIMARY KEY,
+                pid INTEGER NOT NULL,
+                report TEXT NOT NULL
+            );
+        """)
+        for name in (path, path + '-wal', path + '-shm'):
+            if os.path.exists(name):
+                os.chmod(name, 0o600)  # may predate the umask
+
+    @staticmethod
+    def _locked(e: sqlite3.OperationalError) -> bool:
+        return 'locked' in str(e) or 'busy' in str(e)
+
+    def _write(self, sql: str, params: tuple = ()):
+        """Run a write now, or queue it if another worker holds the lock"""
+        if not self._pending:
+            try:
+                self._db.execute(sql, params).fetchall()
+                return
+            except sqlite3.OperationalError as e:
+                if not self._locked(e):
+                    raise
+        self._pending.append((sql, params))
+
+    def _flush(self) -> bool:
+        """Retry queued writes in order; True once none are left"""
+        while self._pending:
+            sql, params = self._pending[0]
+            try:
+                self._db.execute(sql, params).fetchall()
+            except sqlite3.OperationalError as e:
+                if not self._locked(e):
+                    raise
+                return False
+            self._pending.popleft()
+        return True
+
+    def _drop_dead_workers(self):
+        for (pid,) in self._db.execute("SELECT DISTINCT pid FROM in_flight").fetchall():
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                self._db.execute("DELETE FROM in_flight WHERE pid = ?", (pid,))
+            except PermissionError:
+                pass
+
+    def reset(self):
+        """Forget in-flight slots, leases and exhaustion; called before workers start,
+        so a restart retries exhausted accounts as a single process does"""
+        self._db.execute("DELETE FROM in_flight")
+        self._db.execute("DELETE FROM reports")
+        self._db.execute("UPDATE accounts SET lease_owner = 0, lease_until = 0, exhausted = 0")
+
+    def register(self, accounts: List[Account]):
+        for a in accounts:
+            self._write("INSERT OR IGNORE INTO accounts (email, password) VALUES (?, ?)", (a.email, a.password))
+
+    def add_account(self, account: Account):
+        self.register([account])
+
+    def sync(self, pool: 'AccountPool', force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._synced < self.sync_interval:
+            return
+        self._synced = now
+
+        # Until our own queued writes land, the file is older than what we know
+        if not self._flush():
+            return
+        by_email = {a.email: a for a in pool.accounts}
+        try:
+            rows = self._db.execute("""
+                SELECT a.email, a.password, a.jwt, a.jwt_exp, a.user_id, a.session_id, a.cookies,
+                       a.exhausted, a.version,
+                       COALESCE((SELECT SUM(count) FROM in_flight f WHERE f.email = a.email), 0)
+                FROM accounts a
+            """).fetchall()
+        except sqlite3.OperationalError as e:
+            if not self._locked(e):
+                raise
+            return
+        for email, password, jwt, jwt_exp, user_id, session_id, cookies, exhausted, version, in_flight in rows:
+            account = by_email.get(email)
+            if account is None:
+                # Added through another worker's admin endpoint
+                account = Account(email=email, password=password)
+                pool.accounts.append(account)
+            if version > self._versions.get(email, 0):
+                self._versions[email] = version
+                account.jwt, account.jwt_exp = jwt, jwt_exp
+                account.user_id, account.session_id = user_id, session_id
+                account.cookies = self._load_cookies(cookies)
+                pool.token_changed()
+            account.exhausted = bool(exhausted)
+            account.in_flight = in_flight
+
+    def acquire(self, account: Account, limit: int) -> bool:
+        db = self._db
+        try:
+            db.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as e:
+            if not self._locked(e):
+                raise
+            return False
+        try:
+            (total,) = db.execute(
+                "SELECT COALESCE(SUM(count), 0) FROM in_flight WHERE email = ?", (account.email,)
+            ).fetchone()
+            if total >= limit:
+                account.in_flight = total
+                return False
+            db.execute("""
+                INSERT INTO in_flight (email, pid, count) VALUES (?, ?, 1)
+                ON CONFLICT (email, pid) DO UPDATE SET count = count + 1
+            """, (account.email, self.pid))
+            account.in_flight = total + 1
+            return True
+        finally:
+            db.execute("COMMIT")
+
+    def release(self, account: Account):
+        self._write(
+            "UPDATE in_flight SET count = count - 1 WHERE email = ? AND pid = ? AND count > 0",
+            (account.email, self.pid),
+        )
+        account.in_flight = max(0, account.in_flight - 1)
+
+    def lease(self, account: Account, ttl: float) -> bool:
+        now = time.time()
+        try:
+            cursor = self._db.execute("""
+                UPDATE accounts SET lease_owner = ?, lease_until = ?
+                WHERE email = ? AND (lease_until < ? OR lease_owner = ?)
+            """, (self.pid, now + ttl, account.email, now, self.pid))
+        except sqlite3.OperationalError as e:
+            if not self._locked(e):
+                raise
+            return False
+        return cursor.rowcount == 1
+
+    def release_lease(self, account: Account):
+        self._write(
+            "UPDATE accounts SET lease_until = 0 WHERE email = ? AND lease_owner = ?",
+            (account.email, self.pid),
+        )
+
+    def publish_session(self, account: Account):
+        sql = """
+            UPDATE accounts SET jwt = ?, jwt_exp = ?, user_id = ?, session_id = ?, cookies = ?,
+                                exhausted = ?, version = version + 1
+            WHERE email = ? RETURNING version
+        """
+        params = (account.jwt, account.jwt_exp, account.user_id, account.session_id,
+                  self._dump_cookies(account.cookies), int(account.exhausted), account.email)
+        if not self._pending:
+            try:
+                rows = self._db.execute(sql, params).fetchall()
+                if rows:
+                    self._versions[account.email] = rows[0][0]
+                return
+            except sqlite3.OperationalError as e:
+                if not self._locked(e):
+                    raise
+        # Queued: the next sync sees the new version and re-adopts our own session
+        self._pending.append((sql, params))
+
+    @staticmethod
+    def _dump_cookies(jar: Optional[CookieJar]) -> str:
+        return json.dumps([[m.key, m.value, m['domain'], m['path']] for m in jar] if jar is not None else [])
+
+    @staticmethod
+    def _load_cookies(saved: str) -> CookieJar:
+        """Rebuild a jar; cookies come back scoped to their domain and its subdomains"""
+        jar = CookieJar(unsafe=True)
+        entries = json.loads(saved)
+        for name, value, domain, path in entries if isinstance(entries, list) else []:
+            cookie = SimpleCookie()
+            cookie[name] = value
+            cookie[name]['domain'] = domain
+            cookie[name]['path'] = path
+            jar.update_cookies(cookie, URL.build(scheme='https', host=domain))
+        return jar
+
+    def mark_exhausted(self, account: Account):
+        self._write("UPDATE accounts SET exhausted = 1 WHERE email = ?", (account.email,))
+
+    def publish_report(self, worker: int, report: Dict):
+        # Not queued when locked: the next report supersedes it anyway
+        try:
+            self._db.execute(
+                "INSERT OR REPLACE INTO reports (worker, pid, report) VALUES (?, ?, ?)",
+                (worker, self.pid, CODEC.dumps(report).decode('utf-8')),
+            )
+        except sqlite3.OperationalError as e:
+            if not self._locked(e):
+                raise
+
+    def reports(self) -> Dict[str, Dict]:
+        try:
+            rows = self._db.execute("SELECT worker, report FROM reports").fetchall()
+        except sqlite3.OperationalError as e:
+            if not self._locked(e):
+                raise
+            return {}
+        return {str(worker): CODEC.loads(report) for worker, report in rows}
+
+    def close(self):
+        self._db.close()
+
+
+SHARED_STATE_BACKENDS = {cls.name: cls for cls in (SharedState, SQLiteState)}
 
 
 class AccountPool:
-    def __init__(self, accounts: List[Dict[str, str]]):
+    def __init__(self, accounts: List[Dict[str, str]], strategy: Optional[SelectionStrategy] = None,
+                 shared: Optional[SharedState] = None):
         self.accounts = [Account(email=a['email'], password=a['password']) for a in accounts]
+        self._token_changed = asyncio.Event()  # wakes refresh_loop to reschedule
+        self.last_remaining = Account.remaining  # latest quota upstream reported, for cache hits
+        self.shared = shared or SharedState()
+        self.shared.register(self.accounts)
+        self.shared.sync(self, force=True)
+        self.strategy = strategy or SELECTION_STRATEGIES.get(ACCOUNT_SELECTION, LeastInFlightStrategy)()
         self.current_index = 0
-        self._lock = asyncio.Lock()
+        self._http: Optional[ClientSession] = None
+        self._slot_freed = asyncio.Event()
+
+    @property
+    def http(self) -> ClientSession:
+        """Shared upstream session; each account's cookie jar is applied per request"""
+        if self._http is None or self._http.closed:
+            connector = TCPConnector(
+                limit=UPSTREAM_LIMIT,
+                limit_per_host=UPSTREAM_LIMIT_PER_HOST,
+                ttl_dns_cache=UPSTREAM_DNS_TTL,
+                keepalive_timeout=UPSTREAM_KEEPALIVE,
+            )
+            self._http = ClientSession(
+                connector=connector,
+                cookie_jar=DummyCookieJar(),
+                headers={"User-Agent": USER_AGENT},
+                # No overall cap: a long answer may stream for minutes
+                timeout=ClientTimeout(total=None, sock_connect=UPSTREAM_CONNECT_TIMEOUT,
+                                      sock_read=UPSTREAM_IDLE_TIMEOUT),
+            )
+        return self._http
+
+    @asynccontextmanager
+    async def request(self, account: Account, method: str, url: str, headers: Optional[Dict] = None, **kwargs):
+        """Make an upstream request carrying the account's cookies for that host"""
+        jar = account.cookie_jar()
+        headers = dict(headers) if headers else {}
+        cookies = jar.filter_cookies(URL(url))
+        if cookies:
+            headers["Cookie"] = "; ".join(f"{name}={morsel.value}" for name, morsel in cookies.items())
+
+        async with self.http.request(method, url, headers=headers, **kwargs) as resp:
+            for hop in (*resp.history, resp):  # keep cookies set on redirects too
+                jar.update_cookies(hop.cookies, hop.url)
+            yield resp
 
     async def _login(self, account: Account) -> bool:
-        """Login account with its own HTTP session"""
+        """Login account with a fresh set of cookies"""
         print(f"[Pool] Logging in {account.email[:25]}...")
+        started = time.monotonic()
 
         try:
-            # Each account gets its own session with cookie jar
-            if account.http:
-                await account.http.close()
-
-            jar = CookieJar(unsafe=True)
-            account.http = ClientSession(
-                cookie_jar=jar,
-                headers={"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36"}
-            )
+            async with asyncio.timeout(LOGIN_TIMEOUT):
+                return await self._sign_in(account, started)
+        except TimeoutError:
+            print(f"[Pool] Login timed out {account.email[:20]} after {LOGIN_TIMEOUT}s")
+            return False
+
+    async def _sign_in(self, account: Account, started: float) -> bool:
+        """Clerk password sign-in; fills in the account's session and JWT"""
+        try:
+            account.cookies = None
 
             # Get client
-            await account.http.get(f"{CLERK_BASE}/client")
+            async with self.request(account, 'GET', f"{CLERK_BASE}/client"):
+                pass
 
             # Sign in
-            async with account.http.post(
+            async with self.request(
+                account, 'POST',
                 f"{CLERK_BASE}/client/sign_ins",
                 data={"identifier": account.email},
                 headers={"Content-Type": "application/x-www-form-urlencoded"}
@@ -188,7 +1046,8 @@ class AccountPool:
                 return False
 
             # Password
-            async with account.http.post(
+            async with self.request(
+                account, 'POST',
                 f"{CLERK_BASE}/client/sign_ins/{sign_in_id}/attempt_first_factor",
                 data={"strategy": "password", "password": account.password},
                 headers={"Content-Type": "application/x-www-form-urlencoded"}
@@ -202,7 +1061,8 @@ class AccountPool:
             account.session_id = data.get('response', {}).get('created_session_id')
 
             # Get JWT
-            async with account.http.post(
+            async with self.request(
+                account, 'POST',
                 f"{CLERK_BASE}/client/sessions/{account.session_id}/tokens"
             ) as resp:
                 data = await resp.json()
@@ -211,17 +1071,19 @@ class AccountPool:
             if not account.jwt:
                 return False
 
-            # Extract user ID from JWT
+            # Extract user ID and expiry from JWT
             try:
-                payload = account.jwt.split('.')[1]
-                payload += '=' * (4 - len(payload) % 4)
-                decoded = json.loads(base64.urlsafe_b64decode(payload))
+                decoded = decode_jwt_claims(account.jwt)
                 account.user_id = decoded.get('sub', '')
+                account.jwt_exp = float(decoded.get('exp', 0))
             except:
                 account.user_id = str(uuid.uuid4())
+                account.jwt_exp = 0.0
+            self.token_changed()
 
             account.exhausted = False
             account.remaining = 10
+            LOGIN_DURATION.observe(time.monotonic() - started)
             print(f"[Pool] Logged in {account.email[:25]}... OK")
             return True
 
@@ -229,36 +1091,228 @@ class AccountPool:
             print(f"[Pool] Login error {account.email[:20]}: {e}")
             return False
 
-    async def get_account(self) -> Optional[Account]:
-        """Get active account"""
-        async with self._lock:
-            for _ in range(len(self.accounts)):
-                account = self.accounts[self.current_index]
+    async def _login_or_exhaust(self, account: Account) -> bool:
+        if await self._coordinated(account, self._login):
+            return True
+        account.exhausted = True
+        self.shared.mark_exhausted(account)
+        return False
+
+    async def _coordinated(self, account: Account, work) -> bool:
+        """Run a login or token refresh in one worker; the others adopt its session"""
+        if not self.shared.remote:
+            return await work(account)
 
-                if account.exhausted:
-                    self.current_index = (self.current_index + 1) % len(self.accounts)
+        ttl = (LOGIN_TIMEOUT or 30) + 5
+        deadline = time.monotonic() + 2 * ttl
+        while True:
+            self.shared.sync(self, force=True)
+            if account.exhausted:
+                return False
+            if account.token_valid() and (not account.jwt_exp or account.jwt_exp - time.time() > JWT_REFRESH_MARGIN):
+                return True  # another worker just did it
+            if self.shared.lease(account, ttl):
+                try:
+                    ok = await work(account)
+                    if ok:
+                        self.shared.publish_session(account)
+                    return ok
+                finally:
+                    self.shared.release_lease(account)
+            if time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(0.25)
+
+    def _login_future(self, account: Account) -> asyncio.Task:
+        """Start a login for account, or return the one already in flight"""
+        if account.login_task is None or account.login_task.done():
+            account.login_task = asyncio.ensure_future(self._login_or_exhaust(account))
+        return account.login_task
+
+    async def get_account(self, exclude: Optional[set] = None) -> Optional[Account]:
+        """Get active account, skipping any whose email is in exclude
+
+        Selection never awaits, so no lock is needed. Ready accounts below
+        ACCOUNT_MAX_IN_FLIGHT are handed to the selection strategy. Cold
+        accounts log in through a shared per-account task; one is started in
+        the background once every ready account has work, and awaited only
+        when nothing is ready. If every ready account is full this waits for
+        a slot.
+        """
+        while True:
+            self.shared.sync(self)
+            candidates = []
+            cold = None
+            busy = False
+            total = len(self.accounts)
+
+            for offset in range(total):
+                index = (self.current_index + offset) % total
+                account = self.accounts[index]
+
+                if account.exhausted or (exclude and account.email in exclude):
                     continue
+                if not account.token_valid():
+                    cold = cold or account
+                elif account.in_flight >= ACCOUNT_MAX_IN_FLIGHT:
+                    busy = True
+                else:
+                    candidates.append(account)
 
-                if not account.jwt:
-                    if not await self._login(account):
-                        account.exhausted = True
-                        self.current_index = (self.current_index + 1) % len(self.accounts)
-                        continue
+            pending = None
+            if cold is not None and (not candidates or min(a.in_flight for a in candidates) > 0):
+                pending = self._refresh_future(cold) if cold.jwt else self._login_future(cold)
 
+            if candidates:
+                account = self.strategy.choose(candidates)
+                self.current_index = self.accounts.index(account)
                 return account
 
-            return None
+            if pending is None:
+                if not busy:
+                    return None
+                # Slots freed by other workers are only seen by polling
+                try:
+                    await asyncio.wait_for(self._slot_freed.wait(), self.shared.poll_interval)
+                except TimeoutError:
+                    pass
+                continue
+
+            # Shielded so a caller that gives up doesn't cancel a login others share
+            await asyncio.shield(pending)
+
+    async def _refresh_token(self, account: Account) -> bool:
+        """Renew the session token without a full re-login"""
+        try:
+            async with self.request(
+                account, 'POST',
+                f"{CLERK_BASE}/client/sessions/{account.session_id}/tokens",
+                timeout=ClientTimeout(total=LOGIN_TIMEOUT, sock_connect=UPSTREAM_CONNECT_TIMEOUT),
+            ) as resp:
+                if resp.status != 200:
+                    print(f"[Pool] Token refresh {account.email[:20]}: HTTP {resp.status}")
+                    return False
+                data = await resp.json()
 
-    def mark_exhausted(self, account: Account):
+            jwt = data.get('jwt')
+            if not jwt:
+                return False
+
+            account.jwt = jwt
+            try:
+                account.jwt_exp = float(decode_jwt_claims(jwt).get('exp', 0))
+            except:
+                account.jwt_exp = 0.0
+            self.token_changed()
+            return True
+
+        except Exception as e:
+            print(f"[Pool] Token refresh error {account.email[:20]}: {e}")
+            return False
+
+    async def _refresh_or_login(self, account: Account) -> bool:
+        if account.session_id and await self._coordinated(account, self._refresh_token):
+            return True
+        # Session is gone; fall back to a full login
+        account.jwt = None
+        return await asyncio.shield(self._login_future(account))
+
+    def _refresh_future(self, account: Account) -> asyncio.Task:
+        """Start a token refresh for account, or return the one already in flight"""
+        if account.refresh_task is None or account.refresh_task.done():
+            account.refresh_task = asyncio.ensure_future(self._refresh_or_login(account))
+        return account.refresh_task
+
+    def token_changed(self):
+        """A JWT was minted or adopted; refresh_loop reschedules around its expiry"""
+        self._token_changed.set()
+
+    async def refresh_loop(self):
+        """Renew tokens shortly before they expire so requests never wait on it"""
+        while True:
+            self._token_changed.clear()
+            now = time.time()
+            next_due = now + JWT_REFRESH_MAX_SLEEP
+
+            for account in self.accounts:
+                if account.exhausted or not account.jwt or not account.jwt_exp:
+                    continue
+                due = account.jwt_exp - JWT_REFRESH_MARGIN
+                if due <= now:
+                    self._refresh_future(account)
+                else:
+                    next_due = min(next_due, due)
+
+            try:
+                await asyncio.wait_for(self._token_changed.wait(), max(1.0, next_due - now))
+            except TimeoutError:
+                pass
+
+    async def warm_up(self, concurrency: int = WARMUP_CONCURRENCY):
+        """Log in all cold accounts, at most `concurrency` at a time"""
+        sem = asyncio.Semaphore(max(1, concurrency))
+
+        async def warm(account: Account):
+            async with sem:
+                if not account.token_valid() and not account.exhausted:
+                    await asyncio.shield(self._login_future(account))
+
+        start = time.time()
+        async with asyncio.TaskGroup() as tg:
+            for account in list(self.accounts):
+                tg.create_task(warm(account))
+        print(f"[Pool] Warm-up done: {self.ready_count()}/{len(self.accounts)} ready in {time.time() - start:.1f}s")
+
+    def acquire(self, account: Account) -> bool:
+        """Book an in-flight slot; False if other workers took the last one"""
+        return self.shared.acquire(account, ACCOUNT_MAX_IN_FLIGHT)
+
+    async def checkout(self, exclude: Optional[set] = None) -> Optional[Account]:
+        """get_account plus a booked slot"""
+        while True:
+            account = await self.get_account(exclude=exclude)
+            if account is None or self.acquire(account):
+                return account
+            await asyncio.sleep(0)  # the booking lost a race or found the file locked
+
+    def observe_latency(self, account: Account, seconds: float):
+        if account.latency_ewma:
+            account.latency_ewma += LATENCY_EWMA_ALPHA * (seconds - account.latency_ewma)
+        else:
+            account.latency_ewma = seconds
+
+    def release(self, account: Account):
+        self.shared.release(account)
+        self._slot_freed.set()
+        self._slot_freed = asyncio.Event()
+
+    def has_idle(self, exclude: Optional[set] = None) -> bool:
+        """True if some ready account outside exclude has nothing in flight"""
+        return any(
+            not a.exhausted and not a.in_flight and a.token_valid()
+            and not (exclude and a.email in exclude)
+            for a in self.accounts
+        )
+
+    def ready_count(self) -> int:
+        return sum(1 for a in self.accounts if a.token_valid())
+
+    def mark_exhausted(self, account: Account, model: Optional[str] = None):
         account.exhausted = True
         account.remaining = 0
+        self.shared.mark_exhausted(account)
         self.current_index = (self.current_index + 1) % len(self.accounts)
+        ROTATIONS.inc(model=metric_model(model))
         print(f"[Pool] {account.email[:20]}... exhausted, rotating")
 
     async def close(self):
         for account in self.accounts:
-            if account.http:
-                await account.http.close()
+            for task in (account.login_task, account.refresh_task):
+                if task and not task.done():
+                    task.cancel()
+        if self._http:
+            await self._http.close()
+        self.shared.close()
 
     def get_status(self) -> Dict:
         active = [a for a in self.accounts if not a.exhausted]
@@ -266,32 +1320,470 @@ class AccountPool:
             "total_accounts": len(self.accounts),
             "active_accounts": len(active),
             "total_remaining": sum(a.remaining for a in active),
+            "selection": self.strategy.name,
+            "shared_state": self.shared.name,
             "accounts": [
-                {"email": a.email[:20] + "...", "remaining": a.remaining, "active": not a.exhausted}
+                {
+                    "email": a.email[:20] + "...",
+                    "remaining": a.remaining,
+                    "active": not a.exhausted,
+                    "in_flight": a.in_flight,
+                    "latency_ms": round(a.latency_ewma * 1000, 1),
+                }
                 for a in self.accounts
             ]
         }
 
 
 # ==============================================================================
-# Chat Function
+# Stream Parsing
+# ==============================================================================
+
+class NDJSONParser:
+    """Incremental parser for the upstream NDJSON stream.
+
+    Works on raw byte chunks, keeps partial lines across chunk boundaries
+    and returns the text of `content` frames. Frames that fail to parse are
+    counted in `malformed` rather than dropped silently.
+
+    With raw=True the deltas are the content values as encoded JSON string
+    literals (bytes), ready to be spliced into an SSE frame.
+    """
+
+    CONTENT_PREFIX = b'{"kind":"content","content":"'
+    CONTENT_SUFFIX = b'"}'
+
+    def __init__(self, raw: bool = False):
+        self.raw = raw
+        self._buffer = b""
+        self.frames = 0
+        self.malformed = 0
+        self._fast_path = not CODEC.native
+
+    def feed(self, chunk: bytes) -> List:
+        """Consume a chunk and return content deltas from completed lines"""
+        data = self._buffer + chunk if self._buffer else chunk
+        lines = data.split(b"\n")
+        self._buffer = lines.pop()
+        return self._parse_lines(lines)
+
+    def flush(self) -> List:
+        """Parse whatever is left after the stream ends"""
+        data, self._buffer = self._buffer, b""
+        return self._parse_lines([data])
+
+    def _parse_lines(self, lines: List[bytes]) -> List:
+        deltas = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            self.frames += 1
+
+            # Fast path: plain content frame, no JSON decode needed
+            if self._fast_path and line.startswith(self.CONTENT_PREFIX) and line.endswith(self.CONTENT_SUFFIX):
+                raw = line[len(self.CONTENT_PREFIX):-len(self.CONTENT_SUFFIX)]
+                if self.raw and b'"' not in raw:
+                    deltas.append(b'"' + raw + b'"')
+                    continue
+                if b"\\" not in raw and b'"' not in raw:
+                    try:
+                        deltas.append(raw.decode('utf-8'))
+                        continue
+                    except UnicodeDecodeError:
+                        pass
+
+            try:
+                obj = CODEC.loads(line)
+            except ValueError:
+                self.malformed += 1
+                continue
+
+            if isinstance(obj, dict) and obj.get('kind') == 'content':
+                content = obj.get('content', '')
+                if self.raw:
+                    deltas.append(CODEC.dumps(content))
+                else:
+                    deltas.append(content)
+        return deltas
+
+    async def iter_content(self, stream) -> AsyncIterator:
+        """Yield content deltas from an aiohttp StreamReader"""
+        async for chunk in stream.iter_any():
+            for delta in self.feed(chunk):
+                yield delta
+        for delta in self.flush():
+            yield delta
+
+
+def sse_content_frame(literal: bytes) -> bytes:
+    """SSE frame for a content delta given as an encoded JSON string"""
+    return b'data: {"content":' + literal + b'}\n\n'
+
+
+def sse_event(event: str, data: Dict) -> bytes:
+    """Named SSE event with a JSON payload"""
+    return b"event: " + event.encode() + b"\ndata: " + CODEC.dumps(data) + b"\n\n"
+
+
+class SSEHeartbeat:
+    """Writes `: keep-alive` comment frames every `interval` seconds until stopped"""
+
+    def __init__(self, response: web.StreamResponse, interval: float = SSE_HEARTBEAT_INTERVAL):
+        self.response = response
+        self.interval = interval
+        self.sent = 0
+        self._task = asyncio.ensure_future(self._run()) if interval > 0 else None
+
+    async def _run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                await self.response.write(b": keep-alive\n\n")
+                self.sent += 1
+        except (ConnectionError, RuntimeError):
+            pass  # client went away; the handler notices on its next write
+
+    def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+
+class SSERelay:
+    """Coalesces SSE frames into time- and size-bounded writes.
+
+    The first frame is written immediately so time-to-first-token is not
+    delayed; later frames are buffered until `flush_bytes` accumulate or
+    `flush_interval` seconds pass. An interval of 0 writes every frame.
+    """
+
+    def __init__(self, response: web.StreamResponse,
+                 flush_interval: float = SSE_FLUSH_INTERVAL,
+                 flush_bytes: int = SSE_FLUSH_BYTES):
+        self.response = response
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.writes = 0
+        self._buffer: List[bytes] = []
+        self._size = 0
+        self._last_flush = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def send(self, frame: bytes):
+        self._buffer.append(frame)
+        self._size += len(frame)
+
+        if (self._size >= self.flush_bytes
+                or time.monotonic() - self._last_flush >= self.flush_interval):
+            await self.flush()
+        elif self._timer is None:
+            delay = self.flush_interval - (time.monotonic() - self._last_flush)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._flush_later)
+
+    def _flush_later(self):
+        self._timer = None
+        self._flush_task = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return
+
+        data = b"".join(self._buffer)
+        self._buffer.clear()
+        self._size = 0
+        self._last_flush = time.monotonic()
+        self.writes += 1
+        await self.response.write(data)
+
+    async def close(self):
+        """Write anything still buffered"""
+        await self.flush()
+        if self._flush_task and not self._flush_task.done():
+            await self._flush_task
+
+
+# ==============================================================================
+# Upstream Client
 # ==============================================================================
 
-async def do_chat(pool: AccountPool, message: str, model: str = None, history: list = None) -> tuple:
-    """Send chat and return (response_text, account, error)"""
-    if model is None:
-        model = DEFAULT_MODEL
+class UpstreamError(Exception):
+    """Upstream request failed before any content was produced"""
+
+    def __init__(self, message: str, status: int = 500, retry_after: Optional[int] = None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Admission:
+    """A place taken synchronously by `AdmissionController.reserve`: either a
+    running slot or a ticket in the queue, claimed later with `wait`"""
+
+    def __init__(self, controller: 'AdmissionController', waiter: Optional[asyncio.Future] = None):
+        self.controller = controller
+        self._waiter = waiter
+        self._start = time.monotonic()
+        self._claimed = False
+
+    async def wait(self):
+        """Hold the slot, queueing until one frees up; raises a 503
+        UpstreamError on timeout. The holder then calls `controller.release()`."""
+        self._claimed = True
+        waiter = self._waiter
+        if waiter is None:
+            return
+        controller = self.controller
+        timeout = max(0.0, controller.queue_timeout - (time.monotonic() - self._start))
+        try:
+            await asyncio.wait({waiter}, timeout=timeout)
+        except asyncio.CancelledError:
+            if waiter.done():
+                controller.release()
+            else:
+                waiter.cancel()
+            raise
+
+        if not waiter.done():
+            waiter.cancel()
+            controller.timed_out += 1
+            QUEUE_WAIT.observe(controller.queue_timeout)
+            raise controller._reject("Server busy, timed out in queue")
+
+        waited = time.monotonic() - self._start
+        controller.queued += 1
+        controller.wait_total += waited
+        controller.wait_max = max(controller.wait_max, waited)
+        controller.admitted += 1
+        QUEUE_WAIT.observe(waited)
+
+    def cancel(self):
+        """Give the place back unless `wait` already claimed it"""
+        if self._claimed:
+            return
+        self._claimed = True
+        if self._waiter is None or (self._waiter.done() and not self._waiter.cancelled()):
+            self.controller.release()
+        else:
+            self._waiter.cancel()
+
+
+class AdmissionController:
+    """Bounded concurrency in front of the account pool.
+
+    Up to `limit` requests run at once; the rest wait in a FIFO queue of
+    `queue_size` for at most `queue_timeout` seconds. A full queue or an
+    expired wait is rejected with a 503 carrying Retry-After.
+
+    `reserve` takes the slot or queue place without awaiting, so a handler
+    can reject a request before it commits response headers.
+    """
+
+    def __init__(self, pool: 'AccountPool', max_active: int = ADMISSION_MAX_ACTIVE,
+                 queue_size: int = ADMISSION_QUEUE_SIZE,
+                 queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+                 retry_after: int = ADMISSION_RETRY_AFTER):
+        self.pool = pool
+        self.max_active = max_active
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self._waiters: deque = deque()
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.queued = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @property
+    def limit(self) -> int:
+        if self.max_active:
+            return self.max_active
+        usable = sum(1 for a in self.pool.accounts if not a.exhausted)
+        return max(1, usable * ACCOUNT_MAX_IN_FLIGHT)
+
+    def _reject(self, message: str) -> UpstreamError:
+        return UpstreamError(message, status=503, retry_after=self.retry_after)
+
+    def reserve(self) -> Admission:
+        """Take a slot or a queue place now; raises a 503 UpstreamError if the queue is full"""
+        self._wake()  # drop abandoned tickets ahead of us
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            QUEUE_WAIT.observe(0.0)
+            return Admission(self)
+
+        if sum(1 for w in self._waiters if not w.done()) >= self.queue_size:
+            self.rejected += 1
+            raise self._reject("Server busy, queue full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        return Admission(self, waiter)
+
+    async def acquire(self):
+        await self.reserve().wait()
+
+    def release(self):
+        self.active -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.active < self.limit:
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            self.active += 1  # handed over to the waiter
+            waiter.set_result(None)
+
+    def stats(self) -> Dict:
+        return {
+            "active": self.active,
+            "limit": self.limit,
+            "queue_depth": sum(1 for w in self._waiters if not w.done()),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_wait_ms": round(self.wait_total / self.queued * 1000, 1) if self.queued else 0.0,
+            "max_wait_ms": round(self.wait_max * 1000, 1),
+        }
+
+
+@dataclass
+class RetryPolicy:
+    """How many accounts to try and what to retry on"""
+    max_attempts: Optional[int] = None  # None = one attempt per account
+    retry_on_error: bool = True  # connection errors move on to the next account
+    backoff: float = 0.0
+
+    def attempts(self, pool: AccountPool) -> int:
+        return self.max_attempts or len(pool.accounts)
+
 
-    for _ in range(len(pool.accounts)):
-        account = await pool.get_account()
-        if not account:
-            return None, None, "All accounts exhausted"
+@dataclass
+class TimeoutPolicy:
+    """Timeouts applied to each upstream attempt.
+
+    `connect` bounds the TCP/TLS handshake, `first_byte` the time from
+    sending the request to the first content delta, and `idle` every read
+    of the response, headers included. `total` caps the whole attempt.
+    """
+    connect: Optional[float] = UPSTREAM_CONNECT_TIMEOUT
+    first_byte: Optional[float] = UPSTREAM_FIRST_BYTE_TIMEOUT
+    idle: Optional[float] = UPSTREAM_IDLE_TIMEOUT
+    total: Optional[float] = None
+
+    def client_timeout(self) -> ClientTimeout:
+        return ClientTimeout(total=self.total, sock_connect=self.connect, sock_read=self.idle)
+
+
+class UpstreamMetrics:
+    """Hooks for upstream events; the default implementation records nothing"""
+
+    def on_attempt(self, account: Account, model: str, attempt: int):
+        pass
+
+    def on_response(self, account: Account, model: str, seconds: float):
+        pass
+
+    def on_rate_limited(self, account: Account, model: str):
+        pass
+
+    def on_error(self, account: Account, model: str, error: str):
+        pass
+
+    def on_complete(self, account: Account, model: str, parser: NDJSONParser):
+        """Once per stream that got a 200, whether it finished, failed or was abandoned"""
+        pass
+
+
+class PrometheusMetrics(UpstreamMetrics):
+    """Records upstream events into the /metrics registry"""
+
+    def on_attempt(self, account: Account, model: str, attempt: int):
+        if attempt:
+            RETRIES.inc(model=metric_model(model))
+
+    def on_response(self, account: Account, model: str, seconds: float):
+        UPSTREAM_CONNECT.observe(seconds, model=metric_model(model))
+
+    def on_rate_limited(self, account: Account, model: str):
+        RATE_LIMITED.inc(model=metric_model(model))
+
+    def on_error(self, account: Account, model: str, error: str):
+        UPSTREAM_ERRORS.inc(model=metric_model(model))
+
+    def on_complete(self, account: Account, model: str, parser: NDJSONParser):
+        if parser.malformed:
+            PARSE_ERRORS.inc(parser.malformed, model=metric_model(model))
+
+
+class UpstreamStream:
+    """An open upstream response; iterate it for content deltas"""
+
+    def __init__(self, client: 'UpstreamClient', account: Account, resp, model: str,
+                 raw: bool = False, deadline: Optional[asyncio.Timeout] = None):
+        self.client = client
+        self.account = account
+        self.model = model
+        self.resp = resp
+        self.parser = NDJSONParser(raw=raw)
+        self.deadline = deadline
+        self._finished = False
+
+    async def __aiter__(self):
+        async for delta in self.parser.iter_content(self.resp.content):
+            if self.deadline is not None:
+                self.deadline.reschedule(None)  # first token is in
+                self.deadline = None
+            yield delta
+        self.finish()
+
+    def finish(self):
+        """Report the parser's counts once, however the stream ended"""
+        if self._finished:
+            return
+        self._finished = True
+        if self.parser.malformed:
+            print(f"[Upstream] {self.parser.malformed}/{self.parser.frames} malformed frames")
+        self.client.metrics.on_complete(self.account, self.model, self.parser)
+
+
+class UpstreamClient:
+    """Single engine for upstream chat requests.
+
+    Builds the payload, picks accounts, rotates on 429 and retries according
+    to its policies. Both /chat and /stream go through `open`.
+    """
+
+    def __init__(self, pool: AccountPool,
+                 retry: Optional[RetryPolicy] = None,
+                 timeout: Optional[TimeoutPolicy] = None,
+                 metrics: Optional[UpstreamMetrics] = None,
+                 admission: Optional[AdmissionController] = None):
+        self.pool = pool
+        self.admission = admission
+        self.retry = retry or RetryPolicy()
+        self.timeout = timeout or TimeoutPolicy()
+        self.metrics = metrics or UpstreamMetrics()
 
-        # Build prompt with history
+    @staticmethod
+    def build_prompt(message: str, history: Optional[list] = None) -> list:
         prompt = list(history) if history else []
         prompt.append({"role": "user", "content": message})
+        return prompt
 
-        payload = {
+    @staticmethod
+    def build_payload(account: Account, model: str, prompt: list) -> Dict:
+        return {
             "clientProcessingTime": 1,
             "conversationType": "text",
             "includeVeniceSystemPrompt": False,
@@ -307,231 +1799,977 @@ async def do_chat(pool: AccountPool, message: str, model: str = None, history: l
             "webScrapeEnabled": False,
         }
 
+    @staticmethod
+    def build_headers(account: Account) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {account.jwt}",
+            "Content-Type": "application/json",
+            "Origin": "https://venice.ai",
+            "Referer": "https://venice.ai/chat",
+        }
+
+    @asynccontextmanager
+    async def open(self, message: str, model: Optional[str] = None,
+                   history: Optional[list] = None, raw: bool = False,
+                   exclude: Optional[set] = None, admission: Optional[Admission] = None):
+        """Connect to the first account that answers 200 and yield an UpstreamStream.
+
+        Raises UpstreamError if no account could be used. Once the stream is
+        yielded there are no more retries: content may already be on its way
+        to the client. Accounts tried are added to `exclude`, so attempts
+        sharing the set never land on the same account. An `admission`
+        reserved by the caller is claimed instead of acquiring a new one.
+        """
+        model = model or DEFAULT_MODEL
+        prompt = self.build_prompt(message, history)
+        timeout = self.timeout.client_timeout()
+
+        failure = UpstreamError("All accounts exhausted", status=503)
+        tried = exclude if exclude is not None else set()
+
+        controller = admission.controller if admission is not None else self.admission
+        if admission is not None:
+            await admission.wait()
+        elif controller is not None:
+            await controller.acquire()
         try:
-            async with account.http.post(
-                f"{OUTERFACE_BASE}/inference/chat",
-                json=payload,
-                headers={
-                    "Authorization": f"Bearer {account.jwt}",
-                    "Content-Type": "application/json",
-                    "Origin": "https://venice.ai",
-                    "Referer": "https://venice.ai/chat",
-                },
-            ) as resp:
-                remaining = resp.headers.get('x-ratelimit-remaining')
-                if remaining:
-                    account.remaining = int(remaining)
+            for attempt in range(self.retry.attempts(self.pool)):
+                if attempt and self.retry.backoff:
+                    await asyncio.sleep(self.retry.backoff)
+
+                account = await self.pool.checkout(exclude=tried)
+                if not account:
+                    break
+                tried.add(account.email)
+
+                self.metrics.on_attempt(account, model, attempt)
+                streaming = False
+                started = time.monotonic()
+                try:
+                    # Cleared by the stream on the first delta
+                    async with asyncio.timeout(self.timeout.first_byte) as deadline, self.pool.request(
+                        account, 'POST',
+                        f"{OUTERFACE_BASE}/inference/chat",
+                        data=CODEC.dumps(self.build_payload(account, model, prompt)),
+                        headers=self.build_headers(account),
+                        timeout=timeout,
+                    ) as resp:
+                        connect_time = time.monotonic() - started
+                        self.pool.observe_latency(account, connect_time)
+                        self.metrics.on_response(account, model, connect_time)
+                        remaining = resp.headers.get('x-ratelimit-remaining')
+                        if remaining:
+                            account.remaining = int(remaining)
+                            self.pool.last_remaining = account.remaining
+
+                        if resp.status == 429:
+                            self.metrics.on_rate_limited(account, model)
+                            self.pool.mark_exhausted(account, model)
+                            continue
+
+                        if resp.status != 200:
+                            text = await resp.text()
+                            print(f"[Upstream] Venice API error {resp.status}: {text[:200]}")
+                            self.metrics.on_error(account, model, f"HTTP {resp.status}")
+                            raise UpstreamError(text, status=resp.status)
+
+                        streaming = True
+                        stream = UpstreamStream(self, account, resp, model, raw=raw, deadline=deadline)
+                        try:
+                            yield stream
+                        finally:
+                            stream.finish()  # failed and aborted streams count their frames too
+                        return
+                except UpstreamError:
+                    raise
+                except TimeoutError as e:
+                    if streaming:
+                        self.metrics.on_error(account, model, "timeout")
+                        raise UpstreamError("Upstream stopped responding", status=504) from e
+                    print(f"[Upstream] Timeout with account {account.email[:20]}")
+                    self.metrics.on_error(account, model, "timeout")
+                    failure = UpstreamError("Upstream timed out", status=504)
+                    if not self.retry.retry_on_error:
+                        raise failure from e
+                except Exception as e:
+                    if streaming:
+                        raise
+                    print(f"[Upstream] Error with account {account.email[:20]}: {e}")
+                    self.metrics.on_error(account, model, str(e))
+                    if not self.retry.retry_on_error:
+                        raise UpstreamError(str(e)) from e
+                finally:
+                    self.pool.release(account)
+
+            raise failure
+        finally:
+            if controller is not None:
+                controller.release()
+
+
+class HedgeAttempt:
+    """One upstream attempt run in its own task, buffered for whoever reads it"""
+
+    def __init__(self, upstream: UpstreamClient, message: str, model: Optional[str],
+                 history: Optional[list], raw: bool, tried: set, admission: Optional[Admission] = None):
+        self.account: Optional[Account] = None
+        self.first = asyncio.get_running_loop().create_future()  # content (or the end) arrived
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self._run(upstream, message, model, history, raw, tried, admission))
+
+    async def _run(self, upstream: UpstreamClient, message: str, model: Optional[str],
+                   history: Optional[list], raw: bool, tried: set, admission: Optional[Admission]):
+        try:
+            async with upstream.open(message, model, history, raw=raw, exclude=tried,
+                                     admission=admission) as stream:
+                self.account = stream.account
+                async for delta in stream:
+                    self._queue.put_nowait(delta)
+                    if not self.first.done():
+                        self.first.set_result(None)
+            if not self.first.done():
+                self.first.set_result(None)
+        except asyncio.CancelledError:
+            self.first.cancel()
+        except Exception as e:
+            if not self.first.done():
+                self.first.set_exception(e)
+            self._queue.put_nowait(e)
+        finally:
+            self._queue.put_nowait(None)
+
+    def cancel(self):
+        self.task.cancel()
+        if self.first.done() and not self.first.cancelled():
+            self.first.exception()  # a losing attempt's error is not worth a warning
+
+    async def __aiter__(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+class Hedger:
+    """Hedged upstream requests, a drop-in for `UpstreamClient.open`.
+
+    If the first attempt has produced no content after the `percentile` of
+    recent time-to-first-token, a second attempt starts on another idle
+    account. Whichever produces content first is kept and the other is
+    cancelled. Hedges never exceed `budget` of all requests.
+    """
+
+    def __init__(self, upstream: UpstreamClient, percentile: float = HEDGE_PERCENTILE,
+                 budget: float = HEDGE_BUDGET, min_samples: int = HEDGE_MIN_SAMPLES,
+                 window: int = 200):
+        self.upstream = upstream
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.samples: deque = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def delay(self) -> Optional[float]:
+        """Recent TTFT percentile, or None until there are enough samples"""
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
 
-                if resp.status == 429:
-                    pool.mark_exhausted(account)
+    def _can_hedge(self, tried: set) -> bool:
+        if self.hedges + 1 > self.budget * self.requests:
+            return False
+        admission = self.upstream.admission
+        if admission is not None and admission.active >= admission.limit:
+            return False
+        return self.upstream.pool.has_idle(exclude=tried)
+
+    @asynccontextmanager
+    async def open(self, message: str, model: Optional[str] = None,
+                   history: Optional[list] = None, raw: bool = False,
+                   admission: Optional[Admission] = None):
+        self.requests += 1
+        started = time.monotonic()
+        tried = set()
+        attempts = [HedgeAttempt(self.upstream, message, model, history, raw, tried, admission)]
+        try:
+            delay = self.delay()
+            if delay is not None:
+                await asyncio.wait({attempts[0].first}, timeout=delay)
+                if not attempts[0].first.done() and self._can_hedge(tried):
+                    self.hedges += 1
+                    attempts.append(HedgeAttempt(self.upstream, message, model, history, raw, tried))
+
+            winner = await self._race(attempts)
+            self.samples.append(time.monotonic() - started)
+            if len(attempts) > 1:
+                won = winner is attempts[1]
+                self.hedge_wins += won
+                HEDGES.inc(winner="hedge" if won else "primary")
+            yield winner
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    @staticmethod
+    async def _race(attempts: List[HedgeAttempt]) -> HedgeAttempt:
+        """First attempt to produce content; raises if all of them fail"""
+        pending = {attempt.first: attempt for attempt in attempts}
+        error = None
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            for future in done:
+                attempt = pending.pop(future)
+                if future.cancelled():
                     continue
+                if future.exception() is not None:
+                    error = error or future.exception()
+                elif winner is None:
+                    winner = attempt
+            if winner is not None:
+                return winner
+        raise error or UpstreamError("Upstream request failed", status=502)
+
+    def stats(self) -> Dict:
+        delay = self.delay()
+        return {
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "delay_ms": round(delay * 1000, 1) if delay is not None else None,
+        }
 
-                if resp.status != 200:
-                    text = await resp.text()
-                    return None, account, f"API error: {text}"
 
-                # Parse response
-                full_text = ""
-                async for line in resp.content:
-                    if line:
-                        try:
-                            obj = json.loads(line.decode('utf-8'))
-                            if obj.get('kind') == 'content':
-                                full_text += obj.get('content', '')
-                        except:
-                            pass
+def prompt_key(model: str, history: list, message: str) -> str:
+    """Hash of everything that determines the upstream answer"""
+    normalized = [
+        [m.get('role', ''), str(m.get('content', '')).strip()]
+        for m in history if isinstance(m, dict)
+    ]
+    blob = CODEC.dumps([model, SYSTEM_PROMPT, normalized, message.strip()])
+    return hashlib.sha256(blob).hexdigest()
+
+
+class Flight:
+    """One upstream generation shared by every identical in-flight request.
+
+    Content literals are buffered in `parts`, so a subscriber that joins
+    late replays the prefix before following the live stream. Subscribers
+    are counted from `SingleFlight.join` until `leave`; when the last one
+    leaves (or its client disconnects) the upstream request is cancelled.
+    """
+
+    def __init__(self, upstream: UpstreamClient, message: str, model: str, history: list,
+                 admission: Optional[Admission] = None):
+        self.parts: List[bytes] = []
+        self.account: Optional[Account] = None
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.subscribers = 0
+        self._started = asyncio.Event()
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._run(upstream, message, model, history, admission))
+
+    async def _run(self, upstream: UpstreamClient, message: str, model: str, history: list,
+                   admission: Optional[Admission]):
+        try:
+            async with upstream.open(message, model, history, raw=True, admission=admission) as stream:
+                self.account = stream.account
+                self._started.set()
+                async for literal in stream:
+                    self.parts.append(literal)
+                    self._notify()
+        except asyncio.CancelledError as e:
+            self.error = e
+        except Exception as e:
+            if not isinstance(e, UpstreamError):
+                print(f"[Flight] Upstream failed mid-stream: {e}")
+            self.error = e
+        finally:
+            if admission is not None:
+                admission.cancel()  # cancelled before upstream claimed it
+            self.done = True
+            self._started.set()
+            self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _failure(self) -> UpstreamError:
+        if isinstance(self.error, UpstreamError):
+            return self.error
+        return UpstreamError(str(self.error) or "Upstream request failed", status=502)
+
+    async def wait_started(self) -> Account:
+        """Account serving the flight; raises UpstreamError if none could"""
+        await self._started.wait()
+        if self.account is None:
+            raise self._failure()
+        return self.account
+
+    async def deltas(self) -> AsyncIterator[bytes]:
+        """Content literals from the start, then live until the flight ends"""
+        sent = 0
+        while True:
+            while sent < len(self.parts):
+                yield self.parts[sent]
+                sent += 1
+            if self.done:
+                break
+            await self._changed.wait()
+
+        if self.error is not None:
+            raise self._failure()
+
+    def leave(self):
+        self.subscribers -= 1
+        if not self.subscribers and not self.done:
+            self.task.cancel()
+
+
+class SingleFlight:
+    """Registry of in-flight generations keyed by prompt"""
+
+    def __init__(self, upstream: UpstreamClient, enabled: bool = SINGLE_FLIGHT,
+                 hedger: Optional[Hedger] = None):
+        self.upstream = upstream
+        self.hedger = hedger
+        self.enabled = enabled
+        self.flights: Dict[str, Flight] = {}
+        self.coalesced = 0
+
+    def join(self, key: str, message: str, model: str, history: list, hedge: bool = False,
+             admission: Optional[Admission] = None) -> Flight:
+        """Subscribe to the flight for key; the caller must `leave()` it.
+
+        A new flight runs on `admission`; joining a running one hands it back.
+        """
+        flight = self.flights.get(key) if self.enabled else None
+        if flight is not None and not flight.done:
+            self.coalesced += 1
+            if admission is not None:
+                admission.cancel()
+        else:
+            upstream = self.hedger if hedge and self.hedger is not None else self.upstream
+            flight = Flight(upstream, message, model, history, admission)
+            if self.enabled:
+                self.flights[key] = flight
+                flight.task.add_done_callback(lambda _: self._forget(key, flight))
+        flight.subscribers += 1
+        return flight
+
+    def running(self, key: str) -> bool:
+        flight = self.flights.get(key) if self.enabled else None
+        return flight is not None and not flight.done
+
+    def _forget(self, key: str, flight: Flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def stats(self) -> Dict:
+        return {"in_flight": len(self.flights), "coalesced": self.coalesced}
 
-                return full_text, account, None
 
-        except Exception as e:
-            return None, account, str(e)
+# ==============================================================================
+# Conversation Store
+# ==============================================================================
+
+class ConversationStore:
+    """Conversation histories kept server-side, keyed by conversation id.
+
+    Hot conversations live in an in-memory LRU. With a `db_path`, every turn
+    is also appended to SQLite so histories survive restarts and eviction.
+    """
+
+    def __init__(self, capacity: int = CONVERSATION_STORE_SIZE, db_path: str = CONVERSATION_DB):
+        self.capacity = capacity
+        self._cache: 'OrderedDict[str, list]' = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "conversation_id TEXT NOT NULL, seq INTEGER NOT NULL, "
+                "role TEXT NOT NULL, content TEXT NOT NULL, "
+                "PRIMARY KEY (conversation_id, seq))"
+            )
+            self._db.commit()
+
+    def _remember(self, conv_id: str, messages: list):
+        self._cache[conv_id] = messages
+        self._cache.move_to_end(conv_id)
+        while len(self._cache) > self.capacity:
+            self._cache.popitem(last=False)
+
+    def _db_load(self, conv_id: str) -> list:
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY seq",
+                (conv_id,),
+            ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def _db_write(self, conv_id: str, start: int, messages: list, replace: bool):
+        with self._db_lock:
+            if replace:
+                self._db.execute("DELETE FROM messages WHERE conversation_id = ?", (conv_id,))
+            self._db.executemany(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)",
+                [(conv_id, start + i, m.get('role', ''), m.get('content', '')) for i, m in enumerate(messages)],
+            )
+            self._db.commit()
+
+    async def get(self, conv_id: str) -> Optional[list]:
+        messages = self._cache.get(conv_id)
+        if messages is not None:
+            self._cache.move_to_end(conv_id)
+            return messages
+        if self._db is None:
+            return None
+
+        messages = await asyncio.to_thread(self._db_load, conv_id)
+        if not messages:
+            return None
+        self._remember(conv_id, messages)
+        return messages
+
+    async def append(self, conv_id: str, messages: list):
+        history = await self.get(conv_id) or []
+        start = len(history)
+        self._remember(conv_id, history + messages)
+        if self._db is not None:
+            await asyncio.to_thread(self._db_write, conv_id, start, messages, False)
+
+    async def replace(self, conv_id: str, messages: list):
+        self._remember(conv_id, list(messages))
+        if self._db is not None:
+            await asyncio.to_thread(self._db_write, conv_id, 0, messages, True)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+
+
+MAX_CONVERSATION_ID = 64
+
+
+def conversation_id(data: Dict) -> Optional[str]:
+    """The request's `conversation_id` if usable as a store key, else None"""
+    conv_id = data.get('conversation_id')
+    if not conv_id or not isinstance(conv_id, str) or len(conv_id) > MAX_CONVERSATION_ID:
+        return None
+    return conv_id
+
+
+async def resolve_history(store: Optional[ConversationStore], conv_id: Optional[str],
+                          data: Dict) -> Optional[list]:
+    """History for a request, or None if the client has to resend it.
+
+    Clients send `conversation_id` plus `history_length` and may omit
+    `history`; the stored history is used when its length matches. A full
+    `history` always wins and re-seeds the store. `conv_id` comes from
+    `conversation_id(data)`.
+    """
+    history = data.get('history')
+
+    if conv_id is None:
+        return history or []
+
+    if history is not None:
+        if store is not None:
+            await store.replace(conv_id, history)
+        return history
+
+    expected = data.get('history_length', 0)
+    stored = (await store.get(conv_id) if store is not None else None) or []
+    if len(stored) != expected:
+        return None
+    return stored
+
+
+HISTORY_REQUIRED = {"error": "History required", "history_required": True}
+
+MESSAGE_TOKEN_OVERHEAD = 4
+MIN_TRIMMED_TOKENS = 200
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count: ~4 UTF-8 bytes per token"""
+    return len(text.encode('utf-8')) // 4 + MESSAGE_TOKEN_OVERHEAD
+
+
+def compact_history(history: list, model: str) -> tuple:
+    """Fit history into the model's budget; returns (history, dropped_turns).
+
+    Walks from the newest message back. The first message that doesn't fit
+    is cut down to its beginning if enough budget is left, and everything
+    older is dropped. A trimmed message counts as dropped.
+    """
+    budget = HISTORY_BUDGETS.get(model, DEFAULT_HISTORY_BUDGET)
+    kept = []
+    used = 0
+
+    for index in range(len(history) - 1, -1, -1):
+        msg = history[index]
+        content = msg.get('content', '') if isinstance(msg, dict) else ''
+        if not isinstance(content, str):
+            content = str(content)
+        cost = estimate_tokens(content)
+
+        if used + cost <= budget:
+            kept.append(msg)
+            used += cost
+            continue
+
+        left = budget - used - MESSAGE_TOKEN_OVERHEAD
+        if left >= MIN_TRIMMED_TOKENS:
+            head = content.encode('utf-8')[:left * 4].decode('utf-8', 'ignore')
+            kept.append({**msg, "content": head + " …"})
+        dropped = index + 1
+        break
+    else:
+        return history, 0
+
+    kept.reverse()
+    return kept, dropped
+
+
+def decode_literals(literals: List[bytes]) -> str:
+    """Join content deltas received as encoded JSON strings"""
+    return "".join(CODEC.loads(b"[" + b",".join(literals) + b"]"))
+
+
+# ==============================================================================
+# Response Cache
+# ==============================================================================
+
+class ResponseCache:
+    """LRU cache of full answers for identical prompts, with a TTL"""
+
+    def __init__(self, capacity: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, text: str):
+        if not text:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, text)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+# ==============================================================================
+# Traffic Capture
+# ==============================================================================
+
+class TrafficRecorder:
+    """Appends anonymized request shapes to a JSONL file for bench/replay.py.
+
+    Only sizes, model, timing, status and client disconnects are written;
+    message text never is, and conversation ids are hashed with a salt that
+    lives only as long as the process.
+    """
+
+    def __init__(self, path: str = TRAFFIC_CAPTURE):
+        self.path = path
+        self.records = 0
+        self._salt = os.urandom(16)
+        self._started = time.monotonic()
+        self._file = open(path, 'a', buffering=1, encoding='utf-8')  # line-buffered
+        # Marks a new capture segment; `t` below restarts from 0
+        self._file.write(json.dumps({"capture_started": round(time.time(), 3)}) + "\n")
+        print(f"[Capture] Recording request shapes to {path}")
+
+    def shape(self, endpoint: str, data: Optional[Dict], arrived: float) -> Dict:
+        data = data if isinstance(data, dict) else {}
+        message = data.get('message', data.get('prompt', ''))
+        history = data.get('history')
+        conv_id = data.get('conversation_id')
+        inline = isinstance(history, list)
+        return {
+            "t": round(arrived - self._started, 3),
+            "endpoint": endpoint,
+            "model": data.get('model', DEFAULT_MODEL),
+            "message_chars": len(message) if isinstance(message, str) else 0,
+            "history_inline": inline,
+            "history_turns": len(history) if inline else data.get('history_length', 0),
+            "history_chars": sum(len(str(m.get('content', ''))) for m in history if isinstance(m, dict)) if inline else None,
+            "conversation": hashlib.sha256(self._salt + str(conv_id).encode()).hexdigest()[:12] if conv_id else None,
+            "status": None,
+            "duration": None,
+            "disconnected_after": None,
+        }
+
+    def write(self, record: Dict):
+        self.records += 1
+        self._file.write(json.dumps(record, separators=(',', ':')) + "\n")
+
+    def close(self):
+        self._file.close()
+
 
-    return None, None, "All accounts exhausted"
+@web.middleware
+async def capture_middleware(request: web.Request, handler):
+    recorder: Optional[TrafficRecorder] = request.app.get('traffic')
+    if recorder is None or request.path not in ('/chat', '/stream'):
+        return await handler(request)
+
+    arrived = time.monotonic()
+    try:
+        data = await read_json(request)  # the body is cached for the handler
+    except Exception:
+        data = None
+    record = recorder.shape(request.path, data, arrived)
+    try:
+        response = await handler(request)
+        record["status"] = response.status
+        return response
+    except (asyncio.CancelledError, ConnectionError):
+        record["disconnected_after"] = round(time.monotonic() - arrived, 3)
+        raise
+    except Exception:
+        record["status"] = 500
+        raise
+    finally:
+        record["duration"] = round(time.monotonic() - arrived, 3)
+        recorder.write(record)
 
 
 # ==============================================================================
 # HTTP Handlers
 # ==============================================================================
 
+def retry_after_headers(error: UpstreamError) -> Optional[Dict[str, str]]:
+    return {"Retry-After": str(error.retry_after)} if error.retry_after else None
+
+
+def sse_response() -> web.StreamResponse:
+    response = web.StreamResponse()
+    response.content_type = 'text/event-stream'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+async def remember_turn(store: Optional[ConversationStore], conv_id: Optional[str], message: str, answer: str):
+    if store is not None and conv_id:
+        await store.append(conv_id, [
+            {"role": "user", "content": message},
+            {"role": "assistant", "content": answer},
+        ])
+
+
 async def handle_chat(request: web.Request) -> web.Response:
-    pool: AccountPool = request.app['pool']
+    """Full answer as JSON. On a response-cache hit no account is used:
+    `remaining` is the last count upstream reported and X-Cache is HIT."""
+    started = time.monotonic()
+    flights: SingleFlight = request.app['flights']
+    store: Optional[ConversationStore] = request.app['conversations']
 
     try:
-        data = await request.json()
+        data = await read_json(request)
     except:
-        return web.json_response({"error": "Invalid JSON"}, status=400)
+        return json_response({"error": "Invalid JSON"}, status=400)
 
     message = data.get('message', data.get('prompt', ''))
     model = data.get('model', DEFAULT_MODEL)
-    history = data.get('history', [])
 
     if not message:
-        return web.json_response({"error": "No message"}, status=400)
-
-    response, account, error = await do_chat(pool, message, model, history)
-
-    if error:
-        return web.json_response({"error": error}, status=503 if "exhausted" in error else 500)
-
-    return web.json_response({
+        return json_response({"error": "No message"}, status=400)
+
+    conv_id = conversation_id(data)
+    history = await resolve_history(store, conv_id, data)
+    if history is None:
+        return json_response(HISTORY_REQUIRED, status=409)
+    history, dropped = compact_history(history, model)
+
+    cache: Optional[ResponseCache] = request.app['response_cache']
+    key = prompt_key(model, history, message)
+    response = cache.get(key) if cache is not None else None
+    cached = response is not None
+    remaining = request.app['pool'].last_remaining
+
+    if not cached:
+        flight = flights.join(key, message, model, history, hedge=True)
+        try:
+            account = await flight.wait_started()
+            parts = []
+            async for literal in flight.deltas():
+                if not parts:
+                    TTFT.observe(time.monotonic() - started, model=metric_model(model))
+                parts.append(literal)
+        except UpstreamError as e:
+            error = e.message if e.status == 503 else f"API error: {e.message}"
+            return json_response({"error": error}, status=503 if e.status == 503 else 500,
+                                     headers=retry_after_headers(e))
+        finally:
+            flight.leave()
+
+        response = decode_literals(parts)
+        remaining = account.remaining
+        STREAM_DURATION.observe(time.monotonic() - started, model=metric_model(model))
+        if cache is not None:
+            cache.put(key, response)
+
+    await remember_turn(store, conv_id, message, response)
+
+    return json_response({
         "response": response,
-        "remaining": account.remaining if account else 0,
-    })
+        "remaining": remaining,
+        "history_dropped": dropped,
+        "cached": cached,
+    }, headers={'X-Cache': 'HIT'} if cached else None)
 
 
 async def handle_chat_stream(request: web.Request) -> web.StreamResponse:
-    """Streaming chat endpoint with account rotation"""
-    pool: AccountPool = request.app['pool']
+    """Streaming chat endpoint with account rotation.
+
+    Headers are sent before an account is picked. A request that cannot get
+    an admission slot or queue place is refused first with a plain 503 and
+    Retry-After; anything failing after that, a queue timeout included,
+    ends the stream with an `event: error`.
+    """
+    started = time.monotonic()
+    flights: SingleFlight = request.app['flights']
+    store: Optional[ConversationStore] = request.app['conversations']
 
     try:
-        data = await request.json()
+        data = await read_json(request)
     except Exception as e:
         print(f"[Stream] JSON parse error: {e}")
-        return web.json_response({"error": f"Invalid JSON: {e}"}, status=400)
+        return json_response({"error": f"Invalid JSON: {e}"}, status=400)
 
     message = data.get('message', '')
     model = data.get('model', DEFAULT_MODEL)
-    history = data.get('history', [])
 
     if not message:
-        return web.json_response({"error": "No message"}, status=400)
-
-    # Build prompt with history
-    prompt = list(history)
-    prompt.append({"role": "user", "content": message})
-
-    # Try accounts until one works
-    for attempt in range(len(pool.accounts)):
-        account = await pool.get_account()
-        if not account:
-            return web.json_response({"error": "All accounts exhausted"}, status=503)
-
-        payload = {
-            "clientProcessingTime": 1,
-            "conversationType": "text",
-            "includeVeniceSystemPrompt": False,
-            "isCharacter": False,
-            "modelId": model,
-            "prompt": prompt,
-            "reasoning": False,
-            "requestId": str(uuid.uuid4())[:7],
-            "simpleMode": True,
-            "systemPrompt": SYSTEM_PROMPT,
-            "userId": account.user_id,
-            "webEnabled": True,
-            "webScrapeEnabled": False,
-        }
-
+        return json_response({"error": "No message"}, status=400)
+
+    conv_id = conversation_id(data)
+    history = await resolve_history(store, conv_id, data)
+    if history is None:
+        return json_response(HISTORY_REQUIRED, status=409)
+    history, dropped = compact_history(history, model)
+
+    cache: Optional[ResponseCache] = request.app['response_cache']
+    key = prompt_key(model, history, message)
+
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        response = sse_response()
+        response.headers['X-Cache'] = 'HIT'
+        response.headers['X-History-Dropped'] = str(dropped)
+        if store is not None:
+            response.headers['X-Conversation-Store'] = '1'
+        await response.prepare(request)
+        literal = CODEC.dumps(cached)
+        await response.write(sse_content_frame(literal) + b"data: [DONE]\n\n")
+        await remember_turn(store, conv_id, message, cached)
+        return response
+
+    # Reserve a slot or queue place before any header is sent, so overflow
+    # gets a plain 503; the flight claims the reservation instead of acquiring
+    admission: Optional[Admission] = None
+    if not flights.running(key):
         try:
-            async with account.http.post(
-                f"{OUTERFACE_BASE}/inference/chat",
-                json=payload,
-                headers={
-                    "Authorization": f"Bearer {account.jwt}",
-                    "Content-Type": "application/json",
-                    "Origin": "https://venice.ai",
-                    "Referer": "https://venice.ai/chat",
-                },
-            ) as resp:
-                if resp.status == 429:
-                    pool.mark_exhausted(account)
-                    continue  # Try next account
+            admission = request.app['admission'].reserve()
+        except UpstreamError as e:
+            return json_response({"error": e.message}, status=e.status, headers=retry_after_headers(e))
+
+    # Commit the stream before touching the pool: the client gets headers and
+    # a first byte while an account is selected, logged in and connected.
+    # Failures from here on (a queue timeout included) are an `error` event.
+    response = sse_response()
+    response.headers['X-History-Dropped'] = str(dropped)
+    if store is not None:
+        response.headers['X-Conversation-Store'] = '1'
+    try:
+        await response.prepare(request)
+        await response.write(b": connected\n\n")
+    except BaseException:
+        if admission is not None:
+            admission.cancel()
+        raise
+    heartbeat = SSEHeartbeat(response)
+
+    flight = flights.join(key, message, model, history, admission=admission)
+    relay = SSERelay(response)
+    try:
+        account = await flight.wait_started()
+        await response.write(sse_event('meta', {"remaining": account.remaining}))
+
+        first = True
+        async for literal in flight.deltas():
+            if first:
+                heartbeat.stop()
+                TTFT.observe(time.monotonic() - started, model=metric_model(model))
+                first = False
+            await relay.send(sse_content_frame(literal))
+    except UpstreamError as e:
+        heartbeat.stop()
+        await relay.close()
+        error = {"error": e.message, "status": e.status}
+        if e.retry_after:
+            error["retry_after"] = e.retry_after
+        await response.write(sse_event('error', error))
+        return response
+    finally:
+        heartbeat.stop()
+        flight.leave()
+
+    await relay.send(b"data: [DONE]\n\n")
+    await relay.close()
+    STREAM_DURATION.observe(time.monotonic() - started, model=metric_model(model))
+
+    if (store is not None and conv_id) or cache is not None:
+        answer = decode_literals(flight.parts)
+        if cache is not None:
+            cache.put(key, answer)
+        await remember_turn(store, conv_id, message, answer)
+    return response
+
+
+def worker_stats(app: web.Application) -> Dict:
+    """/status sections that are kept per worker process"""
+    stats = {}
+    if app['response_cache'] is not None:
+        stats['response_cache'] = app['response_cache'].stats()
+    stats['single_flight'] = app['flights'].stats()
+    stats['admission'] = app['admission'].stats()
+    stats['worker'] = {"index": app['worker'], "pid": os.getpid()}
+    stats['runtime'] = {"json": CODEC.name, "event_loop": running_loop_name()}
+    if app['hedger'] is not None:
+        stats['hedging'] = app['hedger'].stats()
+    return stats
+
+
+def worker_report(app: web.Application) -> Dict:
+    return {"metrics": METRICS.snapshot(), "status": worker_stats(app)}
+
+
+def worker_reports(app: web.Application) -> Optional[Dict[str, Dict]]:
+    """Every worker's report with ours fresh, or None when running as one process"""
+    shared: SharedState = app['pool'].shared
+    if not shared.remote:
+        return None
+    reports = shared.reports()
+    reports[str(app['worker'])] = worker_report(app)
+    return reports
 
-                if resp.status != 200:
-                    error_text = await resp.text()
-                    print(f"[Stream] Venice API error {resp.status}: {error_text[:200]}")
-                    return web.json_response({"error": error_text}, status=resp.status)
-
-                remaining = resp.headers.get('x-ratelimit-remaining')
-                if remaining:
-                    account.remaining = int(remaining)
-
-                response = web.StreamResponse()
-                response.content_type = 'text/event-stream'
-                response.headers['Cache-Control'] = 'no-cache'
-                response.headers['X-Remaining'] = str(account.remaining)
-                await response.prepare(request)
-
-                async for line in resp.content:
-                    if line:
-                        try:
-                            obj = json.loads(line.decode('utf-8'))
-                            if obj.get('kind') == 'content':
-                                await response.write(f"data: {json.dumps({'content': obj['content']}, ensure_ascii=False)}\n\n".encode('utf-8'))
-                        except:
-                            pass
-
-                await response.write(b"data: [DONE]\n\n")
-                return response
-        except Exception as e:
-            print(f"[Stream] Error with account: {e}")
-            continue  # Try next account
 
-    return web.json_response({"error": "All accounts exhausted"}, status=503)
+async def handle_status(request: web.Request) -> web.Response:
+    status = request.app['pool'].get_status()
+    status.update(worker_stats(request.app))
+    reports = worker_reports(request.app)
+    if reports is not None:
+        status['workers'] = {w: reports[w]['status'] for w in sorted(reports, key=int)}
+    return json_response(status)
 
 
-async def handle_status(request: web.Request) -> web.Response:
-    return web.json_response(request.app['pool'].get_status())
+async def handle_metrics(request: web.Request) -> web.Response:
+    """This process's metrics, or with several workers every worker's series
+    under a `worker` label (each at most WORKER_REPORT_INTERVAL old)"""
+    reports = worker_reports(request.app)
+    workers = {w: report['metrics'] for w, report in reports.items()} if reports is not None else None
+    return web.Response(
+        body=METRICS.render(workers).encode('utf-8'),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
 
 
 async def handle_health(request: web.Request) -> web.Response:
-    return web.json_response({"status": "ok"})
+    pool: AccountPool = request.app['pool']
+    ready = pool.ready_count()
+    required = min(MIN_READY_ACCOUNTS, len(pool.accounts))
+
+    if ready < required:
+        return json_response(
+            {"status": "warming", "ready_accounts": ready, "required": required},
+            status=503,
+        )
+    return json_response({"status": "ok", "ready_accounts": ready})
 
 
 async def handle_add_account(request: web.Request) -> web.Response:
     """Admin endpoint to add a new Venice account"""
-    global ACCOUNTS
-
     try:
-        data = await request.json()
+        data = await read_json(request)
     except:
-        return web.json_response({"error": "Invalid JSON"}, status=400)
+        return json_response({"error": "Invalid JSON"}, status=400)
 
     email = data.get('email', '').strip()
     password = data.get('password', 'London2006)')
 
     if not email:
-        return web.json_response({"error": "Email required"}, status=400)
+        return json_response({"error": "Email required"}, status=400)
 
     pool: AccountPool = request.app['pool']
+    pool.shared.sync(pool, force=True)  # pick up accounts added through other workers
 
     # Check if account already exists
     for acc in pool.accounts:
         if acc.email == email:
-            return web.json_response({"error": "Account already exists"}, status=400)
+            return json_response({"error": "Account already exists"}, status=400)
 
     # Add new account to pool
     new_account = Account(email=email, password=password)
     pool.accounts.append(new_account)
+    pool.shared.add_account(new_account)
 
-    # Also add to global ACCOUNTS and save to Gist
-    ACCOUNTS.append({"email": email, "password": password})
+    # Also update global ACCOUNTS and save to Gist
+    ACCOUNTS[:] = [{"email": a.email, "password": a.password} for a in pool.accounts]
     saved = await save_accounts_to_gist()
 
     print(f"[Admin] Added account: {email} (persisted: {saved})")
-    return web.json_response({
+    return json_response({
         "success": True,
         "total_accounts": len(pool.accounts),
         "persisted": saved
     })
 
 
-async def handle_index(request: web.Request) -> web.Response:
+def render_index(assets: Optional['AssetStore'] = None) -> str:
     html = """<!DOCTYPE html>
 <html lang="ru">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no">
     <title>Nocturne</title>
-    <link rel="preconnect" href="https://fonts.googleapis.com">
-    <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
-    <link href="https://fonts.googleapis.com/css2?family=Montserrat:wght@400;500;600;700&display=swap" rel="stylesheet">
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/styles/atom-one-dark.min.css">
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/KaTeX/0.16.9/katex.min.css">
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/marked/11.1.1/marked.min.js"></script>
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/highlight.min.js"></script>
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/KaTeX/0.16.9/katex.min.js"></script>
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/KaTeX/0.16.9/contrib/auto-render.min.js"></script>
+    <link href="{{asset:vendor/montserrat/montserrat.css}}" rel="stylesheet">
+    <script defer src="{{asset:vendor/marked.min.js}}"></script>
     <style>
         :root {
             --bg: #1D2227;
@@ -1332,6 +3570,7 @@ async def handle_index(request: web.Request) -> web.Response:
         currentConvId: null,
         isAdmin: localStorage.getItem('nocturne_admin') === 'true',
         isStreaming: false,
+        resendHistory: false,
         currentPage: 'chat'
     };
 
@@ -1581,6 +3820,50 @@ async def handle_index(request: web.Request) -> web.Response:
         chatMessages.scrollTop = chatMessages.scrollHeight;
     }
 
+    // ============== Lazy Libraries ==============
+    // highlight.js and KaTeX are only fetched once a message needs them
+    const LAZY_LIBS = {
+        hljs: { js: '{{asset:vendor/highlight.min.js}}', css: '{{asset:vendor/atom-one-dark.min.css}}' },
+        katex: { js: '{{asset:vendor/katex/katex.min.js}}', css: '{{asset:vendor/katex/katex.min.css}}' }
+    };
+    const lazyRequested = {};
+    const markdownSource = new WeakMap();
+
+    // True if the library is ready; otherwise starts loading it once
+    function ensureLib(name) {
+        if (window[name]) return true;
+        if (!lazyRequested[name]) {
+            lazyRequested[name] = true;
+            const lib = LAZY_LIBS[name];
+            const link = document.createElement('link');
+            link.rel = 'stylesheet';
+            link.href = lib.css;
+            document.head.appendChild(link);
+            const script = document.createElement('script');
+            script.src = lib.js;
+            script.onload = rerenderMarkdown;
+            document.head.appendChild(script);
+        }
+        return false;
+    }
+
+    function rerenderMarkdown() {
+        chatMessages.querySelectorAll('.message.assistant .message-content').forEach(el => {
+            const source = markdownSource.get(el);
+            if (source !== undefined) el.innerHTML = renderMarkdown(source);
+        });
+    }
+
+    // Set while rendering the still-growing tail of a streamed answer
+    let deferHighlight = false;
+
+    function highlightCode(code, lang) {
+        if (!ensureLib('hljs') || deferHighlight) return escapeHtml(code);
+        return lang && hljs.getLanguage(lang)
+            ? hljs.highlight(code, { language: lang }).value
+            : hljs.highlightAuto(code).value;
+    }
+
     function addMessageToDOM(role, content, scroll = true) {
         const div = document.createElement('div');
         div.className = 'message ' + (role === 'user' ? 'user' : 'assistant');
@@ -1591,6 +3874,7 @@ async def handle_index(request: web.Request) -> web.Response:
         if (role === 'user') {
             contentDiv.textContent = content;
         } else {
+            markdownSource.set(contentDiv, content);
             contentDiv.innerHTML = renderMarkdown(content);
         }
 
@@ -1602,40 +3886,38 @@ async def handle_index(request: web.Request) -> web.Response:
     }
 
     function renderMarkdown(text) {
-        // Process LaTeX - display mode ($$...$$)
-        text = text.replace(/\$\$([^$]+)\$\$/g, (_, tex) => {
-            try {
-                return katex.renderToString(tex.trim(), { displayMode: true, throwOnError: false });
-            } catch { return '$$' + tex + '$$'; }
-        });
+        const hasMath = text.includes('$') || text.includes('\\\\(') || text.includes('\\\\[');
+        if (hasMath && ensureLib('katex')) {
+            // Process LaTeX - display mode ($$...$$)
+            text = text.replace(/\$\$([^$]+)\$\$/g, (_, tex) => {
+                try {
+                    return katex.renderToString(tex.trim(), { displayMode: true, throwOnError: false });
+                } catch { return '$$' + tex + '$$'; }
+            });
 
-        // Process LaTeX - inline mode ($...$)
-        text = text.replace(/\$([^$]+)\$/g, (_, tex) => {
-            try {
-                return katex.renderToString(tex.trim(), { throwOnError: false });
-            } catch { return '$' + tex + '$'; }
-        });
+            // Process LaTeX - inline mode ($...$)
+            text = text.replace(/\$([^$]+)\$/g, (_, tex) => {
+                try {
+                    return katex.renderToString(tex.trim(), { throwOnError: false });
+                } catch { return '$' + tex + '$'; }
+            });
 
-        // Also support \(...\) and \[...\] syntax
-        text = text.replace(/\\\((.+?)\\\)/g, (_, tex) => {
-            try {
-                return katex.renderToString(tex, { throwOnError: false });
-            } catch { return tex; }
-        });
-        text = text.replace(/\\\[(.+?)\\\]/gs, (_, tex) => {
-            try {
-                return katex.renderToString(tex, { displayMode: true, throwOnError: false });
-            } catch { return tex; }
-        });
+            // Also support \(...\) and \[...\] syntax
+            text = text.replace(/\\\((.+?)\\\)/g, (_, tex) => {
+                try {
+                    return katex.renderToString(tex, { throwOnError: false });
+                } catch { return tex; }
+            });
+            text = text.replace(/\\\[(.+?)\\\]/gs, (_, tex) => {
+                try {
+                    return katex.renderToString(tex, { displayMode: true, throwOnError: false });
+                } catch { return tex; }
+            });
+        }
 
         // Configure marked
         marked.setOptions({
-            highlight: (code, lang) => {
-                if (lang && hljs.getLanguage(lang)) {
-                    return hljs.highlight(code, { language: lang }).value;
-                }
-                return hljs.highlightAuto(code).value;
-            },
+            highlight: highlightCode,
             breaks: true,
             gfm: true
         });
@@ -1643,9 +3925,7 @@ async def handle_index(request: web.Request) -> web.Response:
         // Custom renderer for code blocks
         const renderer = new marked.Renderer();
         renderer.code = (code, lang) => {
-            const highlighted = lang && hljs.getLanguage(lang)
-                ? hljs.highlight(code, { language: lang }).value
-                : hljs.highlightAuto(code).value;
+            const highlighted = highlightCode(code, lang);
             const langLabel = lang || 'code';
             return `<div class="code-block">
                 <div class="code-header">
@@ -1665,6 +3945,82 @@ async def handle_index(request: web.Request) -> web.Response:
         return marked.parse(text, { renderer });
     }
 
+    // Offset just past the last finished block in text[from:]: a blank line or
+    // a closing code fence, outside any open fence or $$ block
+    function stableBoundary(text, from) {
+        let boundary = from;
+        let inFence = false;
+        let inMath = false;
+        let pos = from;
+
+        while (true) {
+            const nl = text.indexOf('\\n', pos);
+            if (nl === -1) break;  // the last line may still be growing
+            const line = text.slice(pos, nl).trim();
+
+            if (line.startsWith('```') || line.startsWith('~~~')) {
+                inFence = !inFence;
+                if (!inFence && !inMath) boundary = nl + 1;
+            } else if (!inFence && (line.split('$$').length - 1) % 2 === 1) {
+                inMath = !inMath;
+            } else if (!inFence && !inMath && line === '') {
+                boundary = nl + 1;
+            }
+            pos = nl + 1;
+        }
+        return boundary;
+    }
+
+    // Streams markdown into container: finished blocks are rendered once and
+    // frozen, only the open tail is re-rendered, at most once per frame
+    function createStreamRenderer(container) {
+        const frozenEl = document.createElement('div');
+        const tailEl = document.createElement('div');
+        let text = '';
+        let frozenUpTo = 0;
+        let frame = 0;
+        let started = false;
+
+        function flush() {
+            frame = 0;
+            if (!started) {
+                container.innerHTML = '';
+                container.append(frozenEl, tailEl);
+                started = true;
+            }
+
+            const cut = stableBoundary(text, frozenUpTo);
+            if (cut > frozenUpTo) {
+                frozenEl.insertAdjacentHTML('beforeend', renderMarkdown(text.slice(frozenUpTo, cut)));
+                frozenUpTo = cut;
+            }
+
+            // Highlighting waits until the code fence closes and the block freezes
+            deferHighlight = true;
+            try {
+                tailEl.innerHTML = renderMarkdown(text.slice(frozenUpTo));
+            } finally {
+                deferHighlight = false;
+            }
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+        }
+
+        return {
+            append(delta) {
+                text += delta;
+                if (!frame) frame = requestAnimationFrame(flush);
+            },
+            // One full render at the end so block joins match a normal render
+            finish() {
+                if (frame) cancelAnimationFrame(frame);
+                frame = 0;
+                if (!text) return;
+                container.innerHTML = renderMarkdown(text);
+                chatMessages.scrollTop = chatMessages.scrollHeight;
+            }
+        };
+    }
+
     window.copyCode = function(btn) {
         const code = btn.closest('.code-block').querySelector('code').textContent;
         navigator.clipboard.writeText(code).then(() => {
@@ -1676,6 +4032,36 @@ async def handle_index(request: web.Request) -> web.Response:
     };
 
     // ============== Send Message ==============
+    function newConversationKey() {
+        if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+        return Date.now().toString(36) + Math.random().toString(36).slice(2) + Math.random().toString(36).slice(2);
+    }
+
+    // The server keeps the history; it is only resent when the server asks
+    async function postStream(conv, text, history) {
+        if (!conv.serverKey) {
+            conv.serverKey = newConversationKey();
+            saveConversations();
+        }
+        const body = { message: text, conversation_id: conv.serverKey, history_length: history.length };
+        if (state.resendHistory) body.history = history;
+
+        const post = () => fetch('/stream', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(body)
+        });
+
+        let resp = await post();
+        if (resp.status === 409) {
+            body.history = history;
+            resp = await post();
+            // Server without a conversation store: always send history from now on
+            if (resp.ok && history.length && !resp.headers.get('X-Conversation-Store')) state.resendHistory = true;
+        }
+        return resp;
+    }
+
     async function sendMessage() {
         const text = messageInput.value.trim();
         if (!text || state.isStreaming) return;
@@ -1736,36 +4122,46 @@ async def handle_index(request: web.Request) -> web.Response:
                 content: m.content
             }));
 
-            const resp = await fetch('/stream', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ message: text, history })
-            });
+            const resp = await postStream(conv, text, history);
+            if (!resp.ok) {
+                const err = await resp.json().catch(() => ({}));
+                throw new Error(err.error || ('HTTP ' + resp.status));
+            }
 
             const reader = resp.body.getReader();
             const decoder = new TextDecoder();
+            const stream = createStreamRenderer(contentDiv);
             let fullText = '';
+            let pending = '';
+            let streamError = null;
 
             while (true) {
                 const { done, value } = await reader.read();
                 if (done) break;
 
-                const chunk = decoder.decode(value);
-                for (const line of chunk.split('\\n')) {
+                // Frames are coalesced server-side; keep any partial line for the next read
+                const lines = (pending + decoder.decode(value, { stream: true })).split('\\n');
+                pending = lines.pop();
+                for (const line of lines) {
                     if (line.startsWith('data: ') && line !== 'data: [DONE]') {
                         try {
                             const data = JSON.parse(line.slice(6));
                             if (data.content) {
                                 fullText += data.content;
-                                contentDiv.innerHTML = renderMarkdown(fullText);
-                                chatMessages.scrollTop = chatMessages.scrollHeight;
+                                stream.append(data.content);
+                            } else if (data.error) {
+                                streamError = data.error;
                             }
                         } catch {}
                     }
                 }
             }
 
+            stream.finish();
+            if (streamError) throw new Error(streamError);
+
             // Save assistant message
+            markdownSource.set(contentDiv, fullText);
             conv.messages.push({ role: 'assistant', content: fullText });
             saveConversations();
 
@@ -1923,13 +4319,220 @@ async def handle_index(request: web.Request) -> web.Response:
     }
 
     // ============== Init ==============
-    updateAdminEntry();
-    renderConversationsList();
-    renderChat();
+    // marked is loaded with defer, so render once the document is parsed
+    document.addEventListener('DOMContentLoaded', () => {
+        updateAdminEntry();
+        renderConversationsList();
+        renderChat();
+    });
     </script>
 </body>
 </html>"""
-    return web.Response(text=html, content_type='text/html')
+    if assets is not None:
+        html = ASSET_PLACEHOLDER.sub(lambda m: assets.url(m.group(1)), html)
+    return html
+
+
+class CompressedPage:
+    """A page rendered once, kept pre-compressed and served with a strong ETag"""
+
+    ENCODINGS = ('br', 'gzip')
+
+    def __init__(self, body: bytes, content_type: str = 'text/html',
+                 cache_control: str = 'no-cache', charset: Optional[str] = 'utf-8',
+                 compress: bool = True):
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.charset = charset
+        digest = hashlib.sha256(body).hexdigest()[:32]
+
+        # Each encoding is its own representation, so each gets its own ETag
+        self.variants = {None: (body, f'"{digest}"')}
+        if compress:
+            self.variants['gzip'] = (gzip.compress(body, compresslevel=9), f'"{digest}-gz"')
+            if brotli is not None:
+                self.variants['br'] = (brotli.compress(body, quality=11), f'"{digest}-br"')
+
+    @staticmethod
+    def _accepted(header: str) -> Dict[str, float]:
+        """Accept-Encoding as {coding: q}; malformed q-values count as 0"""
+        accepted = {}
+        for item in header.lower().split(','):
+            coding, _, params = item.partition(';')
+            coding = coding.strip()
+            if not coding:
+                continue
+            q = 1.0
+            for param in params.split(';'):
+                name, _, value = param.partition('=')
+                if name.strip() == 'q':
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            accepted[coding] = q
+        return accepted
+
+    def _pick_encoding(self, request: web.Request) -> Optional[str]:
+        """Highest-q encoding we have; ties go to ENCODINGS order"""
+        accepted = self._accepted(request.headers.get('Accept-Encoding', ''))
+        best, best_q = None, 0.0
+        for encoding in self.ENCODINGS:
+            q = accepted.get(encoding, accepted.get('*', 0.0))
+            if encoding in self.variants and q > best_q:
+                best, best_q = encoding, q
+        return best
+
+    def response(self, request: web.Request) -> web.Response:
+        encoding = self._pick_encoding(request)
+        body, etag = self.variants[encoding]
+        headers = {
+            'ETag': etag,
+            'Cache-Control': self.cache_control,
+            'Vary': 'Accept-Encoding',
+        }
+
+        if_none_match = request.headers.get('If-None-Match', '')
+        if if_none_match:
+            # Weak comparison (RFC 9110 13.1.2): W/"x" matches "x"
+            tags = [t.strip().removeprefix('W/') for t in if_none_match.split(',')]
+            if '*' in tags or etag in tags:
+                return web.Response(status=304, headers=headers)
+
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return web.Response(body=body, content_type=self.content_type, charset=self.charset, headers=headers)
+
+
+ASSET_PLACEHOLDER = re.compile(r'\{\{asset:([^}]+)\}\}')
+CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+TEXT_TYPES = ('text/', 'application/javascript', 'image/svg+xml')
+
+
+class AssetStore:
+    """Static files under STATIC_DIR, served at content-hashed URLs.
+
+    Hashed URLs never change content, so they are cached as immutable.
+    CSS url() references are rewritten to the hashed names. Names that are
+    not on disk resolve to their CDN fallback.
+    """
+
+    CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+    def __init__(self, root: str = STATIC_DIR, fallbacks: Optional[Dict[str, str]] = None):
+        self.root = root
+        self.fallbacks = fallbacks if fallbacks is not None else VENDOR_ASSETS
+        self.urls: Dict[str, str] = {}
+        self.pages: Dict[str, CompressedPage] = {}
+
+        files = []
+        if os.path.isdir(root):
+            for dirpath, _, filenames in os.walk(root):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    files.append(os.path.relpath(path, root).replace(os.sep, '/'))
+
+        # CSS last, so the files it references already have hashed URLs
+        for name in sorted(files, key=lambda n: n.endswith('.css')):
+            with open(os.path.join(root, name), 'rb') as f:
+                body = f.read()
+            if name.endswith('.css'):
+                body = self._rewrite_css(name, body)
+            self._add(name, body)
+
+        print(f"[Assets] {len(self.pages)} static files from {root}")
+
+    def _add(self, name: str, body: bytes):
+        digest = hashlib.sha256(body).hexdigest()[:10]
+        stem, ext = posixpath.splitext(name)
+        path = f"{stem}.{digest}{ext}"
+
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if name.endswith('.woff2'):
+            content_type = 'font/woff2'
+        is_text = content_type.startswith(TEXT_TYPES)
+
+        self.urls[name] = f"/static/{path}"
+        self.pages[path] = CompressedPage(
+            body, content_type, cache_control=self.CACHE_CONTROL,
+            charset='utf-8' if is_text else None, compress=is_text,
+        )
+
+    def _rewrite_css(self, name: str, body: bytes) -> bytes:
+        base = posixpath.dirname(name)
+
+        def swap(match):
+            ref = match.group(2)
+            if ':' in ref or ref.startswith('/'):
+                return match.group(0)
+            target = posixpath.normpath(posixpath.join(base, ref))
+            return f"url({self.urls[target]})" if target in self.urls else match.group(0)
+
+        return CSS_URL.sub(swap, body.decode('utf-8')).encode('utf-8')
+
+    def url(self, name: str) -> str:
+        return self.urls.get(name) or self.fallbacks[name]
+
+
+def fetch_assets(root: str = STATIC_DIR):
+    """Download VENDOR_ASSETS (and fonts their CSS references) into root"""
+    import urllib.request
+    from urllib.parse import urljoin, urlparse
+
+    def download(url: str) -> bytes:
+        # A browser User-Agent makes Google Fonts serve woff2
+        req = urllib.request.Request(url, headers={"User-Agent": USER_AGENT + " Chrome/120.0 Safari/537.36"})
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            return resp.read()
+
+    def save(name: str, body: bytes):
+        path = os.path.join(root, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(body)
+
+    # A failed download never fails the build: AssetStore falls back to the CDN
+    failed = 0
+    for name, url in VENDOR_ASSETS.items():
+        try:
+            body = download(url)
+        except Exception as e:
+            failed += 1
+            print(f"[Assets] {name} not fetched, will use CDN: {e}")
+            continue
+
+        if name.endswith('.css'):
+            css = body.decode('utf-8')
+            base = posixpath.dirname(name)
+            for ref in sorted({m.group(2) for m in CSS_URL.finditer(css)}):
+                if ref.startswith('data:'):
+                    continue
+                local = "fonts/" + posixpath.basename(urlparse(ref).path)
+                try:
+                    save(posixpath.join(base, local), download(urljoin(url, ref)))
+                except Exception as e:
+                    failed += 1
+                    print(f"[Assets] {local} not fetched, CSS keeps the remote URL: {e}")
+                    local = urljoin(url, ref)
+                css = css.replace(ref, local)
+            body = css.encode('utf-8')
+
+        save(name, body)
+        print(f"[Assets] {name} <- {url}")
+
+    if failed:
+        print(f"[Assets] {failed} download(s) failed; those assets are served from the CDN")
+
+
+async def handle_index(request: web.Request) -> web.Response:
+    return request.app['index'].response(request)
+
+
+async def handle_static(request: web.Request) -> web.Response:
+    page = request.app['assets'].pages.get(request.match_info['path'])
+    if page is None:
+        raise web.HTTPNotFound()
+    return page.response(request)
 
 
 # ==============================================================================
@@ -1937,43 +4540,163 @@ async def handle_index(request: web.Request) -> web.Response:
 # ==============================================================================
 
 async def on_startup(app):
+    app['assets'] = AssetStore()
+    app['index'] = CompressedPage(render_index(app['assets']).encode('utf-8'))
+
     # Load accounts from Gist (or use defaults)
     await load_accounts_from_gist()
-    app['pool'] = AccountPool(ACCOUNTS)
+    shared = SHARED_STATE_BACKENDS.get(SHARED_STATE, SharedState)()
+    app['pool'] = AccountPool(ACCOUNTS, shared=shared)
+    app['admission'] = AdmissionController(app['pool'])
+    app['upstream'] = UpstreamClient(app['pool'], metrics=PrometheusMetrics(), admission=app['admission'])
+
+    pool, admission = app['pool'], app['admission']
+    METRICS.gauge("nocturne_ready_accounts", "Accounts holding a valid JWT", pool.ready_count)
+    METRICS.gauge("nocturne_in_flight", "Upstream requests in flight", lambda: sum(a.in_flight for a in pool.accounts))
+    METRICS.gauge("nocturne_queue_depth", "Requests waiting for admission", lambda: admission.stats()["queue_depth"])
+    app['conversations'] = ConversationStore() if CONVERSATION_STORE_SIZE > 0 else None
+    app['response_cache'] = ResponseCache() if RESPONSE_CACHE_SIZE > 0 else None
+    app['hedger'] = Hedger(app['upstream']) if HEDGE_REQUESTS else None
+    app['traffic'] = TrafficRecorder() if TRAFFIC_CAPTURE else None
+    app['flights'] = SingleFlight(app['upstream'], hedger=app['hedger'])
+
+    if WARMUP_ON_STARTUP:
+        app['warmup'] = asyncio.create_task(app['pool'].warm_up())
+    app['refresher'] = asyncio.create_task(app['pool'].refresh_loop())
+    if shared.remote:
+        app['reporter'] = asyncio.create_task(report_loop(app))
+
+
+async def report_loop(app):
+    """Publish this worker's metrics and stats for whichever worker gets scraped"""
+    while True:
+        app['pool'].shared.publish_report(app['worker'], worker_report(app))
+        await asyncio.sleep(WORKER_REPORT_INTERVAL)
+
 
 async def on_cleanup(app):
+    for key in ('warmup', 'refresher', 'reporter'):
+        task = app.get(key)
+        if task and not task.done():
+            task.cancel()
     await app['pool'].close()
+    if app['conversations'] is not None:
+        app['conversations'].close()
+    if app['traffic'] is not None:
+        app['traffic'].close()
+
+
+def build_app(worker: int = 0) -> web.Application:
+    app = web.Application(middlewares=[capture_middleware] if TRAFFIC_CAPTURE else [])
+    app['worker'] = worker
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+
+    app.router.add_get('/', handle_index)
+    app.router.add_get('/static/{path:.+}', handle_static)
+    app.router.add_post('/chat', handle_chat)
+    app.router.add_post('/stream', handle_chat_stream)
+    app.router.add_get('/status', handle_status)
+    app.router.add_get('/health', handle_health)
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_post('/admin/add-account', handle_add_account)
+    return app
+
+
+def run_workers(host: str, port: int, workers: int):
+    """Pre-fork supervisor: bind once, fork workers that share the socket, restart any that die"""
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+
+    children: Dict[int, int] = {}
+    stopping = False
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                # Cancel handlers of disconnected clients so their upstream requests stop
+                web.run_app(build_app(index), sock=sock, print=None, handler_cancellation=True)
+            except BaseException as e:
+                print(f"[Workers] Worker {index} crashed: {e}")
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = index
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(workers):
+        spawn(index)
+    print(f"[Workers] Started {workers} workers")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            print(f"[Workers] Worker {index} (pid {pid}) exited with status {status}, restarting")
+            time.sleep(1)
+            spawn(index)
 
 
 def main():
+    global SHARED_STATE
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--port', type=int, default=None)
     parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='worker processes sharing the port')
+    parser.add_argument('--fetch-assets', action='store_true', help='download UI assets into STATIC_DIR and exit')
     args = parser.parse_args()
 
+    if args.fetch_assets:
+        fetch_assets()
+        return
+
     # Render.com and other PaaS use PORT env var
     port = args.port or int(os.environ.get('PORT', 8080))
     host = args.host
+    if args.workers > 1 and 'SHARED_STATE' not in os.environ:
+        SHARED_STATE = 'sqlite'
+    loop = install_event_loop()
 
     print("=" * 60)
     print("Nocturne - Venice.ai Proxy Server")
     print(f"Accounts: {len(ACCOUNTS)} | Prompts/day: ~{len(ACCOUNTS) * 10}")
-    print(f"Listening on: {host}:{port}")
+    print(f"Listening on: {host}:{port} | Workers: {args.workers} | Shared state: {SHARED_STATE}")
+    print(f"JSON: {CODEC.name} | Event loop: {loop}")
     print("=" * 60)
 
-    app = web.Application()
-    app.on_startup.append(on_startup)
-    app.on_cleanup.append(on_cleanup)
+    if SHARED_STATE == 'sqlite':
+        state = SQLiteState()
+        state.reset()
+        state.close()
+        print(f"[Workers] Shared account state in {SHARED_STATE_DB}")
 
-    app.router.add_get('/', handle_index)
-    app.router.add_post('/chat', handle_chat)
-    app.router.add_post('/stream', handle_chat_stream)
-    app.router.add_get('/status', handle_status)
-    app.router.add_get('/health', handle_health)
-    app.router.add_post('/admin/add-account', handle_add_account)
+    if args.workers > 1:
+        run_workers(host, port, args.workers)
+        return
 
-    web.run_app(app, host=host, port=port, print=None)
+    # Cancel handlers of disconnected clients so their upstream requests stop
+    web.run_app(build_app(), host=host, port=port, print=None, handler_cancellation=True)
 
 
 if __name__ == "__main__":